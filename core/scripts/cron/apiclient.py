@@ -0,0 +1,81 @@
+'''
+ApiClient
+
+Client for the protected RPM API server shared by the cron scripts.
+
+* Keeps connections alive across requests (one pooled requests.Session)
+* Retries failed requests (connection errors, timeouts, 5xx responses) with exponential backoff
+* Sends lists of items to the batch endpoints in chunks instead of one request per item
+
+'''
+
+
+import json
+import requests
+
+from time import sleep
+
+
+class ApiClient:
+
+    MAX_RETRIES = 3
+    BACKOFF_FACTOR = 0.5            # Wait 0.5s, 1s, 2s, ... between retries
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    POOL_SIZE = 10
+    TIMEOUT = 30
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, base_url, max_retries=None, backoff_factor=None, pool_size=None):
+        self.base_url = base_url
+        self.max_retries = max_retries if max_retries is not None else ApiClient.MAX_RETRIES
+        self.backoff_factor = backoff_factor if backoff_factor is not None else ApiClient.BACKOFF_FACTOR
+        pool_size = pool_size if pool_size is not None else ApiClient.POOL_SIZE
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def _request(self, method, endpoint, **kwargs):
+        url = '{}{}'.format(self.base_url, endpoint)
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = self.session.request(method, url, timeout=ApiClient.TIMEOUT, **kwargs)
+                if r.status_code not in ApiClient.RETRY_STATUS_CODES:
+                    return json.loads(r.text)
+                error = "HTTP {}".format(r.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            except Exception as e:
+                print("[ERROR] ApiClient.{} {}: {}".format(method.lower(), url, e))
+                return None
+            if attempt < self.max_retries:
+                sleep(self.backoff_factor * (2 ** attempt))
+        print("[ERROR] ApiClient.{} {} failed after {} retries: {}".format(method.lower(), url, self.max_retries, error))
+        return None
+
+
+    def get(self, endpoint, params=None):
+        return self._request('GET', endpoint, params=params)
+
+
+    def post(self, endpoint, payload):
+        return self._request('POST', endpoint, json=payload)
+
+
+    def post_batch(self, endpoint, items, batch_size=None):
+        # Returns True if all chunks of items have been accepted
+        if batch_size is None:
+            batch_size = ApiClient.MAX_BATCH_SIZE
+        success = True
+        for start in range(0, len(items), batch_size):
+            response = self.post(endpoint, items[start:start+batch_size])
+            if not ApiClient.is_success(response):
+                success = False
+        return success
+
+
+    @staticmethod
+    def is_success(response):
+        return response is not None and response.get('msg') in ['success', 'OK']
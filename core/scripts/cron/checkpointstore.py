@@ -0,0 +1,68 @@
+'''
+CheckpointStore
+
+Local write-ahead store for a single checkpoint value (e.g., the ObjectId of the latest
+processed MongoDB document). Every update is written to a local file right away, so that
+a crashed script can resume from the last processed item; the (slower) remote copy of
+the checkpoint is only updated every flush_interval updates and on flush().
+
+'''
+
+
+import os
+import json
+
+
+class CheckpointStore:
+
+    def __init__(self, path, remote_setter=None, flush_interval=1000):
+        self.path = path
+        self.remote_setter = remote_setter
+        self.flush_interval = flush_interval
+        self.value = None
+        self.flushed_value = None
+        self.num_updates = 0
+        self.num_updates_flushed = 0
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.value = json.load(f)['value']
+            except Exception as e:
+                print("[ERROR] CheckpointStore: could not read {}: {}".format(self.path, e))
+
+
+    def get(self):
+        return self.value
+
+
+    def set(self, value, auto_flush=True):
+        self.value = value
+        # Write to a temporary file first, so that a crash never leaves a truncated checkpoint behind
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump({'value': value}, f)
+        os.replace(tmp_path, self.path)
+
+        self.num_updates += 1
+        # With auto_flush=False, the caller takes care of flushing (e.g., outside of an event loop, see flush_due())
+        if auto_flush and self.flush_due():
+            self.flush()
+
+
+    def flush_due(self):
+        # Returns True (once) if flush_interval updates have been made since the last flush
+        if self.num_updates - self.num_updates_flushed < self.flush_interval:
+            return False
+        self.num_updates_flushed = self.num_updates
+        return True
+
+
+    def flush(self):
+        self.num_updates_flushed = self.num_updates
+        if self.remote_setter is None or self.value is None or self.value == self.flushed_value:
+            return True
+        if self.remote_setter(self.value):
+            self.flushed_value = self.value
+            return True
+        return False
@@ -1,7 +1,13 @@
+import sys
+import time
+import threading
 import pymysql.cursors
 import pymysql
+import numpy as np
+import pandas as pd
 
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 
 class DailyUpdater:
@@ -11,91 +17,293 @@ class DailyUpdater:
     MYSQL_PASSWORD = '!!5656tT'
     MYSQL_DBNAME = 'rpmdb'
 
+    # Time (database clock) up to which all changes have been rolled up by run_incremental()
+    PARAM_NAME__HIGH_WATER_MARK = 'dailyupdater_high_water_mark'
+
+    # Columns of the joined article/category/signal rows used by the pandas backend
+    ROLLUP_ROW_COLUMNS = ['published_at', 'article_id', 'article_source', 'article_category', 'signal_source', 'signal_type', 'signal_value']
+    ROLLUP_FETCH_SIZE = 10000
+
     def __init__(self):
-        self.db = pymysql.connect(host=DailyUpdater.MYSQL_HOST,
-                                  user=DailyUpdater.MYSQL_USER,
-                                  passwd=DailyUpdater.MYSQL_PASSWORD,
-                                  database=DailyUpdater.MYSQL_DBNAME,
-                                  autocommit=True)
+        # Each thread uses its own connection (see run() with num_workers > 1)
+        self.local = threading.local()
 
 
-    def run(self):
-        self._update_news_article_counts()
-        self._update_news_article_social_signals()
-        self._update_news_article_rankings()
+    @property
+    def db(self):
+        if not hasattr(self.local, 'db'):
+            self.local.db = pymysql.connect(host=DailyUpdater.MYSQL_HOST,
+                                            user=DailyUpdater.MYSQL_USER,
+                                            passwd=DailyUpdater.MYSQL_PASSWORD,
+                                            database=DailyUpdater.MYSQL_DBNAME,
+                                            autocommit=True)
+        return self.local.db
 
 
-    def _update_news_article_counts(self):
-        dates = self._create_dates()
-        dates = [ "'{}'".format(d) for d in dates ]
+    def run(self, num_workers=1, backend='sql'):
+        if backend == 'pandas':
+            return self.run_pandas()
+        # Every step processes one day at a time, each day in its own transaction (several days in parallel if num_workers > 1)
+        self._update_news_article_counts(num_workers=num_workers)
+        self._update_news_article_social_signals(num_workers=num_workers)
+        self._update_news_article_rankings(num_workers=num_workers)
 
-        sql = "INSERT IGNORE INTO rpm_news_articles_count_daily \
-               SELECT DATE(a.published_at) AS published_at, a.source, c.category, COUNT(*) AS article_count \
-               FROM rpm_news_articles a, rpm_pages_categories c \
-               WHERE a.id = c.url_id \
-               AND DATE(a.published_at) IN ({}) \
-               GROUP BY DATE(a.published_at), a.source, c.category".format(", ".join(dates))
 
-        #print(sql)
-        try:
-            with self.db.cursor() as cursor:
-                cursor.execute(sql)
-        except Exception as e:
-            print(e)
+    def run_pandas(self):
+        # Alternative backend: the joined rows are read once and aggregated in Python, so that MySQL only has to
+        # serve a plain range scan and bulk inserts instead of three aggregating INSERT ... SELECT statements
+        dates = self._create_dates(start_offset=12)
+        count_dates = self._create_dates()
 
+        start_time = time.time()
+        rows = self._fetch_rollup_rows(dates[0], dates[-1])
+        print("fetch rollup rows: {} rows [{:.2f}s]".format(len(rows), time.time() - start_time))
 
+        start_time = time.time()
+        article_counts = DailyUpdater.compute_article_counts(rows)
+        social_signal_counts = DailyUpdater.compute_social_signal_counts(rows)
+        rankings = DailyUpdater.compute_rankings(rows)
+        print("compute rollups [{:.2f}s]".format(time.time() - start_time))
 
-    def _update_news_article_social_signals(self):
-        dates = self._create_dates(start_offset=12)
-        dates = [ "'{}'".format(d) for d in dates ]
+        self._write_rollup('news article counts', 'rpm_news_articles_count_daily', article_counts, count_dates)
+        self._write_rollup('news article social signals', 'rpm_news_articles_social_signals_count_daily', social_signal_counts, dates)
+        self._write_rollup('news article rankings', 'rpm_news_articles_ranking', rankings, dates, insert='INSERT IGNORE')
 
-        sql = "DELETE FROM rpm_news_articles_social_signals_count_daily WHERE published_at IN ({})".format(", ".join(dates))
-        #print(sql)
+
+    def run_incremental(self):
+        # Only recompute the (date, source, category) groups with articles, categories or social signals that have
+        # been added or changed since the last run; falls back to run() if there has been no incremental run yet
+        high_water_mark = self._get_parameter(DailyUpdater.PARAM_NAME__HIGH_WATER_MARK)
+        new_high_water_mark = self._get_database_time()
+
+        if high_water_mark is None:
+            self.run()
+        else:
+            changed_groups = self._get_changed_groups(high_water_mark, new_high_water_mark)
+            for date in sorted(changed_groups):
+                if not self._update_groups(date, sorted(changed_groups[date])):
+                    # Keep the old high-water mark so that the changes are picked up again next time
+                    return False
+
+        return self._set_parameter(DailyUpdater.PARAM_NAME__HIGH_WATER_MARK, new_high_water_mark)
+
+
+    def _get_parameter(self, name):
         try:
             with self.db.cursor() as cursor:
-                cursor.execute(sql)
+                cursor.execute("SELECT value FROM rpm_parameters WHERE name = %s", (name,))
+                row = cursor.fetchone()
+                return row[0] if row is not None else None
         except Exception as e:
             print(e)
+            return None
 
-        sql = "INSERT INTO rpm_news_articles_social_signals_count_daily \
-               SELECT DATE(a.published_at) AS published_at, a.source AS article_source, c.category, s.signal_source AS signal_source, s.signal_type, SUM(s.signal_value) AS cnt \
-               FROM rpm_news_articles a, rpm_pages_categories c, rpm_pages_social_signals s \
-               WHERE a.id = s.url_id AND a.id = c.url_id AND s.url_id = c.url_id \
-               AND s.signal_value > 0 \
-               AND DATE(a.published_at) IN ({}) \
-               GROUP BY a.source, DATE(a.published_at), c.category, s.signal_source, s.signal_type".format(", ".join(dates))
-        #print(sql)
+
+    def _set_parameter(self, name, value):
         try:
             with self.db.cursor() as cursor:
-                cursor.execute(sql)
+                cursor.execute("INSERT INTO rpm_parameters (name, value) VALUES (%s, %s) ON DUPLICATE KEY UPDATE value = VALUES(value)", (name, value))
+            return True
         except Exception as e:
             print(e)
+            return False
 
 
-    def _update_news_article_rankings(self):
-        dates = self._create_dates(start_offset=12)
-        dates = [ "'{}'".format(d) for d in dates ]
+    def _get_database_time(self):
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT DATE_FORMAT(NOW(), '%Y-%m-%d %H:%i:%s')")
+            return cursor.fetchone()[0]
 
-        sql = "DELETE FROM rpm_news_articles_ranking WHERE published_at IN ({})".format(", ".join(dates))
-        #print(sql)
-        try:
-            with self.db.cursor() as cursor:
-                cursor.execute(sql)
-        except Exception as e:
-            print(e)
 
-        sql = "INSERT IGNORE INTO rpm_news_articles_ranking \
-               SELECT DATE(a.published_at) as published_at, a.id, a.source AS article_source, c.category AS article_category, s.signal_source AS signal_source, s.signal_type AS signal_type, s.signal_value \
+    def _get_changed_groups(self, high_water_mark, new_high_water_mark):
+        # Returns a dictionary: date => set of (source, category) pairs that need to be recomputed
+        # (rpm_news_articles.updated_at is used for scheduling by the NASS updater, so created_at is used for articles).
+        # The high-water marks only have a precision of one second, so the interval is half-open: changes made within
+        # the second of new_high_water_mark are left for the next run instead of being skipped
+        sql = "SELECT DISTINCT DATE(a.published_at) AS published_at, a.source, c.category \
                FROM rpm_news_articles a, rpm_pages_categories c, rpm_pages_social_signals s \
-               WHERE a.id = s.url_id AND a.id = c.url_id AND s.url_id = c.url_id AND \
-               DATE(a.published_at) IN ({})".format(", ".join(dates))
-        #print(sql)
+               WHERE a.id = s.url_id AND a.id = c.url_id \
+               AND s.updated_at >= '{0}' AND s.updated_at < '{1}' \
+               UNION \
+               SELECT DISTINCT DATE(a.published_at) AS published_at, a.source, c.category \
+               FROM rpm_news_articles a, rpm_pages_categories c \
+               WHERE a.id = c.url_id \
+               AND a.created_at >= '{0}' AND a.created_at < '{1}' \
+               UNION \
+               SELECT DISTINCT DATE(a.published_at) AS published_at, a.source, c.category \
+               FROM rpm_news_articles a, rpm_pages_categories c \
+               WHERE a.id = c.url_id \
+               AND c.updated_at >= '{0}' AND c.updated_at < '{1}'".format(high_water_mark, new_high_water_mark)
+
+        changed_groups = {}
+        with self.db.cursor() as cursor:
+            cursor.execute(sql)
+            for published_at, source, category in cursor.fetchall():
+                changed_groups.setdefault(published_at.strftime('%Y-%m-%d'), set()).add((int(source), int(category)))
+        return changed_groups
+
+
+    def _update_groups(self, date, groups):
+        # Recompute all rollups for the given (source, category) pairs of one day in a single transaction
+        statements = self._news_article_counts_statements(date, groups=groups) \
+                     + self._news_article_social_signals_statements(date, groups=groups) \
+                     + self._news_article_rankings_statements(date, groups=groups)
+        return self._execute_transaction(statements)
+
+
+    def _update_news_article_counts(self, num_workers=1):
+        return self._run_step('news article counts', self._news_article_counts_statements, self._create_dates(), num_workers=num_workers)
+
+
+    def _update_news_article_social_signals(self, num_workers=1):
+        return self._run_step('news article social signals', self._news_article_social_signals_statements, self._create_dates(start_offset=12), num_workers=num_workers)
+
+
+    def _update_news_article_rankings(self, num_workers=1):
+        return self._run_step('news article rankings', self._news_article_rankings_statements, self._create_dates(start_offset=12), num_workers=num_workers)
+
+
+    def _run_step(self, name, generate_statements, dates, num_workers=1):
+        start_time = time.time()
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                results = list(pool.map(lambda date: self._execute_transaction(generate_statements(date)), dates))
+        else:
+            results = [ self._execute_transaction(generate_statements(date)) for date in dates ]
+        print("{}: {}/{} days updated [{:.2f}s]".format(name, sum(results), len(dates), time.time() - start_time))
+        return all(results)
+
+
+    def _execute_transaction(self, statements):
         try:
+            self.db.begin()
             with self.db.cursor() as cursor:
-                cursor.execute(sql)
+                for sql in statements:
+                    cursor.execute(sql)
+            self.db.commit()
+            return True
         except Exception as e:
             print(e)
-
+            self.db.rollback()
+            return False
+
+
+    def _published_at_condition(self, date):
+        # Half-open range instead of DATE(a.published_at), so that an index on published_at can be used
+        return "a.published_at >= '{0}' AND a.published_at < '{0}' + INTERVAL 1 DAY".format(date)
+
+
+    def _groups_conditions(self, groups):
+        # Returns the conditions restricting the rollup tables and the source tables to the given (source, category) pairs
+        if groups is None:
+            return "", ""
+        groups_str = ", ".join([ "({}, {})".format(int(source), int(category)) for source, category in groups ])
+        return " AND (article_source, article_category) IN ({})".format(groups_str), " AND (a.source, c.category) IN ({})".format(groups_str)
+
+
+    def _news_article_counts_statements(self, date, groups=None):
+        rollup_condition, groups_condition = self._groups_conditions(groups)
+        return [
+            "DELETE FROM rpm_news_articles_count_daily WHERE published_at = '{}'{}".format(date, rollup_condition),
+            "INSERT INTO rpm_news_articles_count_daily \
+             SELECT DATE(a.published_at) AS published_at, a.source, c.category, COUNT(*) AS article_count \
+             FROM rpm_news_articles a, rpm_pages_categories c \
+             WHERE a.id = c.url_id \
+             AND {}{} \
+             GROUP BY DATE(a.published_at), a.source, c.category".format(self._published_at_condition(date), groups_condition)
+        ]
+
+
+    def _news_article_social_signals_statements(self, date, groups=None):
+        rollup_condition, groups_condition = self._groups_conditions(groups)
+        return [
+            "DELETE FROM rpm_news_articles_social_signals_count_daily WHERE published_at = '{}'{}".format(date, rollup_condition),
+            "INSERT INTO rpm_news_articles_social_signals_count_daily \
+             SELECT DATE(a.published_at) AS published_at, a.source AS article_source, c.category, s.signal_source AS signal_source, s.signal_type, SUM(s.signal_value) AS cnt \
+             FROM rpm_news_articles a, rpm_pages_categories c, rpm_pages_social_signals s \
+             WHERE a.id = s.url_id AND a.id = c.url_id AND s.url_id = c.url_id \
+             AND s.signal_value > 0 \
+             AND {}{} \
+             GROUP BY a.source, DATE(a.published_at), c.category, s.signal_source, s.signal_type".format(self._published_at_condition(date), groups_condition)
+        ]
+
+
+    def _news_article_rankings_statements(self, date, groups=None):
+        rollup_condition, groups_condition = self._groups_conditions(groups)
+        return [
+            "DELETE FROM rpm_news_articles_ranking WHERE published_at = '{}'{}".format(date, rollup_condition),
+            "INSERT IGNORE INTO rpm_news_articles_ranking \
+             SELECT DATE(a.published_at) as published_at, a.id, a.source AS article_source, c.category AS article_category, s.signal_source AS signal_source, s.signal_type AS signal_type, s.signal_value \
+             FROM rpm_news_articles a, rpm_pages_categories c, rpm_pages_social_signals s \
+             WHERE a.id = s.url_id AND a.id = c.url_id AND s.url_id = c.url_id \
+             AND {}{}".format(self._published_at_condition(date), groups_condition)
+        ]
+
+
+    def _fetch_rollup_rows(self, first_date, last_date):
+        # Stream all joined rows of the date range with an unbuffered cursor; articles without signals are kept (for the counts)
+        sql = "SELECT DATE_FORMAT(a.published_at, '%Y-%m-%d') AS published_at, a.id, a.source, c.category, s.signal_source, s.signal_type, s.signal_value \
+               FROM rpm_news_articles a JOIN rpm_pages_categories c ON a.id = c.url_id LEFT JOIN rpm_pages_social_signals s ON a.id = s.url_id \
+               WHERE a.published_at >= '{}' AND a.published_at < '{}' + INTERVAL 1 DAY".format(first_date, last_date)
+
+        frames = []
+        with self.db.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(sql)
+            while True:
+                chunk = cursor.fetchmany(DailyUpdater.ROLLUP_FETCH_SIZE)
+                if len(chunk) == 0:
+                    break
+                frames.append(pd.DataFrame.from_records(chunk, columns=DailyUpdater.ROLLUP_ROW_COLUMNS))
+
+        if len(frames) == 0:
+            return pd.DataFrame(columns=DailyUpdater.ROLLUP_ROW_COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+
+    @staticmethod
+    def compute_article_counts(rows):
+        articles = rows[['published_at', 'article_id', 'article_source', 'article_category']].drop_duplicates()
+        counts = articles.groupby(['published_at', 'article_source', 'article_category'], sort=False).size()
+        return counts.reset_index(name='article_count').astype({'article_count': np.int64})
+
+
+    @staticmethod
+    def compute_social_signal_counts(rows):
+        signals = rows[rows['signal_value'].fillna(0).to_numpy() > 0]
+        signals = signals.astype({'signal_source': np.int64, 'signal_type': np.int64, 'signal_value': np.int64})
+        counts = signals.groupby(['published_at', 'article_source', 'article_category', 'signal_source', 'signal_type'], sort=False)['signal_value'].sum()
+        return counts.reset_index()
+
+
+    @staticmethod
+    def compute_rankings(rows):
+        rankings = rows[rows['signal_value'].notna().to_numpy()]
+        rankings = rankings.astype({'signal_source': np.int64, 'signal_type': np.int64, 'signal_value': np.int64})
+        return rankings[['published_at', 'article_id', 'article_source', 'article_category', 'signal_source', 'signal_type', 'signal_value']]
+
+
+    def _write_rollup(self, name, table, frame, dates, insert='INSERT'):
+        # Replace the rows of each day in its own transaction, inserting the new rows with executemany
+        start_time = time.time()
+        frames_by_date = { date: day_frame for date, day_frame in frame.groupby('published_at', sort=False) }
+        sql = "{} INTO {} VALUES ({})".format(insert, table, ", ".join(["%s"] * len(frame.columns)))
+        results = []
+        for date in dates:
+            records = frames_by_date[date].astype(object).values.tolist() if date in frames_by_date else []
+            try:
+                self.db.begin()
+                with self.db.cursor() as cursor:
+                    cursor.execute("DELETE FROM {} WHERE published_at = %s".format(table), (date,))
+                    if len(records) > 0:
+                        cursor.executemany(sql, records)
+                self.db.commit()
+                results.append(True)
+            except Exception as e:
+                print(e)
+                self.db.rollback()
+                results.append(False)
+        print("{}: {}/{} days updated [{:.2f}s]".format(name, sum(results), len(dates), time.time() - start_time))
+        return all(results)
 
 
     def _create_dates(self, start_offset=2, end_offset=2):
@@ -114,4 +322,11 @@ if __name__ == '__main__':
 
     daily_updater = DailyUpdater()
 
-    daily_updater.run()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'incremental':
+        daily_updater.run_incremental()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'pandas':
+        daily_updater.run(backend='pandas')
+    elif len(sys.argv) > 1:
+        daily_updater.run(num_workers=int(sys.argv[1]))
+    else:
+        daily_updater.run()
\ No newline at end of file
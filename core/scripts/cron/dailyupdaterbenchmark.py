@@ -0,0 +1,134 @@
+'''
+Benchmark of the two DailyUpdater backends (aggregating SQL statements vs. pandas)
+
+Fills a scratch database with a synthetic set of news articles, categories and social
+signals published within the date range rolled up by DailyUpdater, runs both backends
+on it, prints their run times and checks that both produce the same rollup tables.
+
+Usage: python dailyupdaterbenchmark.py <scratch-db-name> [<num-articles>]
+
+All tables of the scratch database used by DailyUpdater are dropped and recreated, so
+never run this against the production database.
+
+'''
+
+
+import sys
+import time
+import random
+import pymysql
+
+from datetime import datetime, timedelta
+from dailyupdater import DailyUpdater
+
+
+NUM_ARTICLES = 100000
+NUM_SOURCES = 20
+NUM_CATEGORIES = 5
+MAX_CATEGORIES_PER_ARTICLE = 2
+SIGNAL_SOURCES = [200]
+SIGNAL_TYPES = [1, 2, 3]
+INSERT_BATCH_SIZE = 5000
+
+TABLES = [
+    "CREATE TABLE rpm_news_articles (id BIGINT PRIMARY KEY, source VARCHAR(64) NOT NULL, published_at DATETIME NOT NULL, created_at DATETIME NOT NULL, KEY (published_at))",
+    "CREATE TABLE rpm_pages_categories (url_id BIGINT NOT NULL, category INT NOT NULL, updated_at DATETIME NOT NULL, PRIMARY KEY (url_id, category))",
+    "CREATE TABLE rpm_pages_social_signals (url_id BIGINT NOT NULL, signal_source INT NOT NULL, signal_type INT NOT NULL, signal_value BIGINT NOT NULL, created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL, PRIMARY KEY (url_id, signal_source, signal_type))",
+    "CREATE TABLE rpm_news_articles_count_daily (published_at DATE NOT NULL, article_source VARCHAR(64) NOT NULL, article_category INT NOT NULL, article_count INT NOT NULL, PRIMARY KEY (published_at, article_source, article_category))",
+    "CREATE TABLE rpm_news_articles_social_signals_count_daily (published_at DATE NOT NULL, article_source VARCHAR(64) NOT NULL, article_category INT NOT NULL, signal_source INT NOT NULL, signal_type INT NOT NULL, value BIGINT NOT NULL, PRIMARY KEY (published_at, article_source, article_category, signal_source, signal_type))",
+    "CREATE TABLE rpm_news_articles_ranking (published_at DATE NOT NULL, article_id BIGINT NOT NULL, article_source VARCHAR(64) NOT NULL, article_category INT NOT NULL, signal_source INT NOT NULL, signal_type INT NOT NULL, signal_value BIGINT NOT NULL, PRIMARY KEY (published_at, article_id, article_category, signal_source, signal_type))",
+]
+
+ROLLUP_TABLES = ['rpm_news_articles_count_daily', 'rpm_news_articles_social_signals_count_daily', 'rpm_news_articles_ranking']
+
+
+def create_tables(db):
+    with db.cursor() as cursor:
+        for sql in TABLES:
+            table = sql.split()[2]
+            cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+            cursor.execute(sql)
+
+
+def generate_data(db, num_articles):
+    # Articles are spread over the 12 days before and the day after today (the range covered by DailyUpdater)
+    now = datetime.now()
+    start_date = now - timedelta(days=12)
+    span = (now + timedelta(days=1) - start_date).total_seconds()
+
+    articles, categories, signals = [], [], []
+    for article_id in range(1, num_articles+1):
+        published_at = start_date + timedelta(seconds=random.random() * span)
+        articles.append((article_id, 'source{}'.format(random.randrange(NUM_SOURCES)), published_at, now))
+        for category in random.sample(range(1, NUM_CATEGORIES+1), random.randint(1, MAX_CATEGORIES_PER_ARTICLE)):
+            categories.append((article_id, category, now))
+        if random.random() < 0.8:
+            for signal_source in SIGNAL_SOURCES:
+                for signal_type in SIGNAL_TYPES:
+                    # Many articles never get any engagement
+                    signal_value = int(random.paretovariate(1.2)) - 1
+                    signals.append((article_id, signal_source, signal_type, signal_value, now, now))
+
+    with db.cursor() as cursor:
+        for sql, rows in [("INSERT INTO rpm_news_articles VALUES (%s, %s, %s, %s)", articles),
+                          ("INSERT INTO rpm_pages_categories VALUES (%s, %s, %s)", categories),
+                          ("INSERT INTO rpm_pages_social_signals VALUES (%s, %s, %s, %s, %s, %s)", signals)]:
+            for start in range(0, len(rows), INSERT_BATCH_SIZE):
+                cursor.executemany(sql, rows[start:start+INSERT_BATCH_SIZE])
+    print("generated {} articles, {} categories, {} signals".format(len(articles), len(categories), len(signals)))
+
+
+def clear_rollups(db):
+    with db.cursor() as cursor:
+        for table in ROLLUP_TABLES:
+            cursor.execute("TRUNCATE TABLE {}".format(table))
+
+
+def read_rollups(db):
+    rollups = {}
+    with db.cursor() as cursor:
+        for table in ROLLUP_TABLES:
+            cursor.execute("SELECT * FROM {}".format(table))
+            rollups[table] = sorted([ tuple(str(value) for value in row) for row in cursor.fetchall() ])
+    return rollups
+
+
+def run_backend(db, backend):
+    clear_rollups(db)
+    start_time = time.time()
+    DailyUpdater().run(backend=backend)
+    elapsed = time.time() - start_time
+    print("==> backend '{}': {:.2f}s".format(backend, elapsed))
+    return elapsed, read_rollups(db)
+
+
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: python dailyupdaterbenchmark.py <scratch-db-name> [<num-articles>]")
+        sys.exit(1)
+
+    db_name = sys.argv[1]
+    if db_name == DailyUpdater.MYSQL_DBNAME:
+        print("[ERROR] refusing to run the benchmark against '{}'".format(db_name))
+        sys.exit(1)
+
+    num_articles = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_ARTICLES
+
+    DailyUpdater.MYSQL_DBNAME = db_name
+    db = pymysql.connect(host=DailyUpdater.MYSQL_HOST, user=DailyUpdater.MYSQL_USER, passwd=DailyUpdater.MYSQL_PASSWORD, database=db_name, autocommit=True)
+
+    create_tables(db)
+    generate_data(db, num_articles)
+
+    sql_time, sql_rollups = run_backend(db, 'sql')
+    pandas_time, pandas_rollups = run_backend(db, 'pandas')
+
+    for table in ROLLUP_TABLES:
+        status = 'OK' if sql_rollups[table] == pandas_rollups[table] else 'MISMATCH'
+        print("{}: {} rows (sql), {} rows (pandas) [{}]".format(table, len(sql_rollups[table]), len(pandas_rollups[table]), status))
+    print("speedup: {:.2f}x".format(sql_time / pandas_time if pandas_time > 0 else float('inf')))
+
+    db.close()
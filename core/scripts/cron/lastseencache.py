@@ -0,0 +1,42 @@
+'''
+LastSeenCache
+
+Bounded key/value cache with least-recently-used eviction, used to remember the last
+value written for each item (e.g., each (url id, signal type) pair) so that only values
+that have changed since need to be written again.
+
+'''
+
+
+from collections import OrderedDict
+
+
+class LastSeenCache:
+
+    MAX_SIZE = 1000000
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size if max_size is not None else LastSeenCache.MAX_SIZE
+        self.items = OrderedDict()
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+    def has_changed(self, key, value):
+        return self.get(key) != value
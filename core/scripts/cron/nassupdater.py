@@ -24,6 +24,12 @@ import yaml
 
 from datetime import date, timedelta, datetime
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from apiclient import ApiClient
+from tokenpool import TokenPool
+from refreshqueue import RefreshQueue
+from lastseencache import LastSeenCache
 
 
 class NewsArticleSocialSignalUpdater:
@@ -33,6 +39,8 @@ class NewsArticleSocialSignalUpdater:
 
     FB_APP_ID = config['channel']['facebook']['app_id']
     FB_APP_SECRET = config['channel']['facebook']['app_secret']
+    # Can be pointed to a local fake of the Graph API for testing
+    FB_GRAPH_URL = config['channel']['facebook'].get('graph_url', 'https://graph.facebook.com')
 
     MYSQL_HOST = config['database']['mysql']['host']
     MYSQL_USER = config['database']['mysql']['user']
@@ -40,11 +48,28 @@ class NewsArticleSocialSignalUpdater:
     MYSQL_DBNAME = config['database']['mysql']['dbname']
 
     ACCESS_TOKEN = config['script']['nassupdater']['access_token']
+    # Optional list of further apps ({app_id, app_secret, access_token}) whose tokens are used in parallel
+    FB_APPS = config['script']['nassupdater'].get('apps') or [ {'app_id': FB_APP_ID, 'app_secret': FB_APP_SECRET, 'access_token': ACCESS_TOKEN} ]
 
     SERVER_IP = config['url']['api_server']
 
+    API_ENDPOINT__SOCIAL_SIGNALS = '/pages/socialsignals/'
+    API_ENDPOINT__SOCIAL_SIGNALS_BATCH = '/pages/socialsignals/batch/'
+
+    SIGNAL_SOURCE__FACEBOOK = 200
+    SIGNAL_TYPE__COMMENT_COUNT = 201
+    SIGNAL_TYPE__REACTION_COUNT = 202
+    SIGNAL_TYPE__SHARE_COUNT = 203
+
     URL_MAX_AGE_IN_DAYS = 10
 
+    # Maximum number of URLs per Graph API request
+    BATCH_SIZE = 50
+    # Seconds after which articles added to the database since the last load are added to the refresh queue
+    QUEUE_RELOAD_INTERVAL = 3600
+    # Number of Graph API requests in flight in process_parallel()
+    NUM_WORKERS = 4
+
     FB_API_ERR__UNKNOWN = 1001
     FB_API_ERR__REQUEST_LIMIT_REACHED = 1002
     FB_API_ERR__ACCESS_TOKEN_ISSUE = 1003
@@ -60,19 +85,37 @@ class NewsArticleSocialSignalUpdater:
 
         self.access_token = NewsArticleSocialSignalUpdater.ACCESS_TOKEN
 
+        self.api_client = ApiClient(NewsArticleSocialSignalUpdater.SERVER_IP)
+
+        # Each token has its own request budget; replaces the fixed pause of 20 seconds between batches
+        self.token_pool = TokenPool(NewsArticleSocialSignalUpdater.FB_APPS, self.refresh_access_token)
+
+        self.refresh_queue = RefreshQueue()
+        self.refresh_queue_loaded_at = None
+        self.refresh_queue_db_time = None      # database time of the last load, to only load articles added since
+
+        # Last signal values written per (url id, signal type), to write only signals that have changed
+        self.signal_cache = LastSeenCache()
+
+    def refresh_access_token(self, app_id, app_secret):
+        return facebook.GraphAPI().get_app_access_token(app_id, app_secret)
+
+    def get_error_code(self, response_json):
+        if 'limit' in response_json['error']['message']:
+            return NewsArticleSocialSignalUpdater.FB_API_ERR__REQUEST_LIMIT_REACHED
+        elif 'token' in response_json['error']['message']:
+            return NewsArticleSocialSignalUpdater.FB_API_ERR__ACCESS_TOKEN_ISSUE
+        else:
+            return NewsArticleSocialSignalUpdater.FB_API_ERR__UNKNOWN
+
     def get_engagement(self, url):
 
         try:
-            response = requests.get('https://graph.facebook.com/?id={}&fields=engagement&access_token={}'.format(url, self.access_token))
+            response = requests.get('{}/?id={}&fields=engagement&access_token={}'.format(NewsArticleSocialSignalUpdater.FB_GRAPH_URL, url, self.access_token))
             response_json = json.loads(response.text)
             x_app_usage = json.loads(response.headers['x-app-usage'])
             if 'error' in response_json:
-                if 'limit' in response_json['error']['message']:
-                    return None, x_app_usage, NewsArticleSocialSignalUpdater.FB_API_ERR__REQUEST_LIMIT_REACHED
-                elif 'token' in response_json['error']['message']:
-                    return None, x_app_usage, NewsArticleSocialSignalUpdater.FB_API_ERR__ACCESS_TOKEN_ISSUE
-                else:
-                    return None, x_app_usage, NewsArticleSocialSignalUpdater.FB_API_ERR__UNKNOWN
+                return None, x_app_usage, self.get_error_code(response_json)
             else:
                 engagement = None
                 if 'engagement' in  response_json:
@@ -85,7 +128,7 @@ class NewsArticleSocialSignalUpdater:
 
     def get_share_count(self, url):
         try:
-            response = requests.get('https://graph.facebook.com/?fields=share&id={}'.format(url))
+            response = requests.get('{}/?fields=share&id={}'.format(NewsArticleSocialSignalUpdater.FB_GRAPH_URL, url))
             x_app_usage = json.loads(response.headers['x-app-usage'])
             share_count = json.loads(response.text)['share']['share_count']
             return share_count, x_app_usage
@@ -93,13 +136,17 @@ class NewsArticleSocialSignalUpdater:
             print(e)
             return None, None
 
-    def get_share_data(self, url_list):
+    def get_share_data(self, url_list, access_token=None):
+        if access_token is None:
+            access_token = self.access_token
         try:
             urls_string = ','.join(map(str, url_list))
             urls_string = urllib.parse.quote(urls_string)
-            response = requests.get("https://graph.facebook.com/v2.2/?ids={}&access_token={}&fields=engagement".format(urls_string, self.access_token))
-            x_app_usage = json.loads(response.headers['x-app-usage'])
+            response = requests.get("{}/v2.2/?ids={}&access_token={}&fields=engagement".format(NewsArticleSocialSignalUpdater.FB_GRAPH_URL, urls_string, access_token))
+            x_app_usage = json.loads(response.headers.get('x-app-usage', '{}'))
             response_json = json.loads(response.text)
+            if 'error' in response_json:
+                return None, x_app_usage, self.get_error_code(response_json)
             return response_json, x_app_usage, 0
         except Exception as e:
             print(e)
@@ -107,13 +154,12 @@ class NewsArticleSocialSignalUpdater:
 
 
 
-    def set_updated_at(self, url_ids_list, date_str):
-        if len(url_ids_list) == 0:
+    def set_next_poll_times(self, next_poll_times):
+        # next_poll_times: list of (url id, datetime) tuples; updated_at holds the time of the next poll (see load_refresh_queue())
+        if len(next_poll_times) == 0:
             return
-        id_str_line = ','.join(["'{}'".format(id_str) for id_str in url_ids_list])
-        query = "UPDATE rpm_news_articles SET updated_at = STR_TO_DATE('{}','%Y-%m-%d %H:%i:%s') WHERE id IN ({})".format(date_str, id_str_line)
         with self.db.cursor() as cursor:
-            cursor.execute(query)
+            cursor.executemany("UPDATE rpm_news_articles SET updated_at = %s WHERE id = %s", [ (due_at.strftime('%Y-%m-%d %H:%M:%S'), url_id) for url_id, due_at in next_poll_times ])
 
 
     def set_flag(self, url_ids_list, value):
@@ -139,67 +185,178 @@ class NewsArticleSocialSignalUpdater:
         return batch
 
 
+    def load_refresh_queue(self, min_date_str):
+        # Add all articles that are not in the refresh queue yet, together with their current total engagement.
+        # This single query replaces the ORDER BY updated_at query per batch; the range condition on published_at
+        # comes first so that an index on it can be used. Reloads only consider articles added since the last load
+        # (created_at has a precision of one second, so articles of that second are read again and skipped)
+        query = "SELECT a.id, a.url, a.published_at, a.updated_at, SUM(s.signal_value) FROM rpm_news_articles a LEFT JOIN rpm_pages_social_signals s ON s.url_id = a.id AND s.signal_source = {} WHERE a.published_at >= STR_TO_DATE('{}', '%Y-%m-%dT%TZ') AND a.valid = 1 AND MOD(GREATEST(a.valid, a.flag), 3) <> 0".format(NewsArticleSocialSignalUpdater.SIGNAL_SOURCE__FACEBOOK, min_date_str)
+        if self.refresh_queue_db_time is not None:
+            query += " AND a.created_at >= '{}'".format(self.refresh_queue_db_time)
+        query += " GROUP BY a.id, a.url, a.published_at, a.updated_at"
+        now = datetime.now()
+        cnt = 0
+        with self.db.cursor() as cursor:
+            # Taken from the database (not this machine) since it is compared with created_at
+            cursor.execute("SELECT DATE_FORMAT(NOW(), '%Y-%m-%d %H:%i:%s')")
+            db_time = cursor.fetchone()[0]
+        with self.db.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(query)
+            for url_id, url, published_at, updated_at, engagement in cursor:
+                url_id = str(url_id)
+                if url_id in self.refresh_queue:
+                    continue
+                # updated_at holds the time of the next poll as scheduled by earlier runs
+                due_at = updated_at if updated_at is not None else now
+                self.refresh_queue.push(url_id, url.lower(), published_at, due_at, engagement=int(engagement) if engagement is not None else None)
+                cnt += 1
+        self.refresh_queue_loaded_at = now
+        self.refresh_queue_db_time = db_time
+        return cnt
+
+
+    def prime_signal_cache(self, min_date_str):
+        query = "SELECT s.url_id, s.signal_type, s.signal_value FROM rpm_news_articles a, rpm_pages_social_signals s WHERE a.id = s.url_id AND s.signal_source = {} AND a.published_at >= STR_TO_DATE('{}', '%Y-%m-%dT%TZ')".format(NewsArticleSocialSignalUpdater.SIGNAL_SOURCE__FACEBOOK, min_date_str)
+        with self.db.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(query)
+            for url_id, signal_type, signal_value in cursor:
+                self.signal_cache.set((str(url_id), signal_type), signal_value)
+
+
+    def filter_changed_signals(self, signals):
+        return [ signal for signal in signals if self.signal_cache.has_changed((str(signal['url_id']), signal['signal_type']), signal['signal_value']) ]
+
+
+    def generate_social_signals(self, url_id_str, share_count, comment_count, reaction_count):
+        signals = []
+        if share_count > 0:
+            signals.append({"signal_source": NewsArticleSocialSignalUpdater.SIGNAL_SOURCE__FACEBOOK, "signal_type": NewsArticleSocialSignalUpdater.SIGNAL_TYPE__SHARE_COUNT, "signal_value": share_count, "url_id": url_id_str})
+        if reaction_count > 0:
+            signals.append({"signal_source": NewsArticleSocialSignalUpdater.SIGNAL_SOURCE__FACEBOOK, "signal_type": NewsArticleSocialSignalUpdater.SIGNAL_TYPE__REACTION_COUNT, "signal_value": reaction_count, "url_id": url_id_str})
+        if comment_count > 0:
+            signals.append({"signal_source": NewsArticleSocialSignalUpdater.SIGNAL_SOURCE__FACEBOOK, "signal_type": NewsArticleSocialSignalUpdater.SIGNAL_TYPE__COMMENT_COUNT, "signal_value": comment_count, "url_id": url_id_str})
+        return signals
+
+
     def post_social_signals(self, url_id_str, share_count, comment_count, reaction_count):
-        try:
-            if share_count > 0:
-                r = requests.post(NewsArticleSocialSignalUpdater.server_ip +'/pages/socialsignals/', json={"signal_source": 200, "signal_type": 203, "signal_value": share_count, "url_id": url_id_str})
-            if reaction_count > 0:
-                r = requests.post(NewsArticleSocialSignalUpdater.server_ip + '/pages/socialsignals/', json={"signal_source": 200, "signal_type": 202, "signal_value": reaction_count, "url_id": url_id_str})
-            if comment_count > 0:
-                r = requests.post(NewsArticleSocialSignalUpdater.server_ip + '/pages/socialsignals/', json={"signal_source": 200, "signal_type": 201, "signal_value": comment_count, "url_id": url_id_str})
-            return True
-        except Exception as e:
-            print("[Error] NewsArticleSocialSignalUpdater.post_social_signals:", e)
+        return self.post_social_signals_batch(self.generate_social_signals(url_id_str, share_count, comment_count, reaction_count))
+
+
+    def post_social_signals_batch(self, signals):
+        success = self.api_client.post_batch(NewsArticleSocialSignalUpdater.API_ENDPOINT__SOCIAL_SIGNALS_BATCH, signals)
+        if not success:
+            print("[Error] NewsArticleSocialSignalUpdater.post_social_signals_batch: failed to post {} signals".format(len(signals)))
             return False
+        for signal in signals:
+            self.signal_cache.set((str(signal['url_id']), signal['signal_type']), signal['signal_value'])
+        return True
 
 
-    def process_batch(self, min_date_str):
-        batch = self.get_next_article_batch(min_date_str)
+    def pop_next_batch(self, min_date_str):
+        if self.refresh_queue_loaded_at is None:
+            self.prime_signal_cache(min_date_str)
+        if self.refresh_queue_loaded_at is None or (datetime.now() - self.refresh_queue_loaded_at).total_seconds() > NewsArticleSocialSignalUpdater.QUEUE_RELOAD_INTERVAL:
+            self.load_refresh_queue(min_date_str)
 
-        x_app_usage = {}
+        return self.refresh_queue.pop_due(NewsArticleSocialSignalUpdater.BATCH_SIZE)
 
-        if len(batch) == 0:
-            return True, x_app_usage
 
-        url_ids_list = [ str(tup[0]) for tup in batch ]
+    def request_share_data(self, batch):
+        # Safe to run in worker threads (no database access)
         url_list = [ str(tup[1]) for tup in batch ]
 
-        _, _, last_published_at = batch[-1]
-
-        response, x_app_usage, error = self.get_share_data(url_list)
-        response = {k.lower(): v for k, v in response.items()}
+        slot, access_token = self.token_pool.acquire()
+        response, x_app_usage, error = self.get_share_data(url_list, access_token=access_token)
+        self.token_pool.update(slot, x_app_usage)
 
         if error == NewsArticleSocialSignalUpdater.FB_API_ERR__REQUEST_LIMIT_REACHED:
+            # Back off to the minimum rate for this token
             print("Application request limit reached: {}".format(str(x_app_usage)))
-            return True, x_app_usage, last_published_at
+            self.token_pool.throttle(slot)
 
         if error == NewsArticleSocialSignalUpdater.FB_API_ERR__ACCESS_TOKEN_ISSUE:
-            print("Access token issue: {}".format(self.access_token))
-            self.access_token = self.graph.get_app_access_token(NewsArticleSocialSignalUpdater.FB_APP_ID, NewsArticleSocialSignalUpdater.FB_APP_SECRET)
-            print("New access token: {}".format(self.access_token))
-            return False, x_app_usage, last_published_at
+            print("Access token issue: {}".format(access_token))
+            new_access_token = self.token_pool.refresh(slot, access_token)
+            print("New access token: {}".format(new_access_token))
+
+        return response, x_app_usage, error
+
+
+    def handle_share_data(self, batch, response, x_app_usage, error):
+        # Returns True if processing should stop
+        url_ids_list = [ str(tup[0]) for tup in batch ]
+        url_list = [ str(tup[1]) for tup in batch ]
+
+        if error in [NewsArticleSocialSignalUpdater.FB_API_ERR__REQUEST_LIMIT_REACHED, NewsArticleSocialSignalUpdater.FB_API_ERR__ACCESS_TOKEN_ISSUE]:
+            # Try the same batch again
+            self.refresh_queue.requeue(batch)
+            return False
 
         if error == NewsArticleSocialSignalUpdater.FB_API_ERR__UNKNOWN:
             print("Unknown error")
-            return True, x_app_usage, last_published_at
+            self.refresh_queue.requeue(batch)
+            return True
 
+        response = {k.lower(): v for k, v in response.items()}
+
+        # Collect the signals of all URLs that have changed since they were last written and send them with a single request
+        signals = []
+        total_engagements = {}
         for idx in range(len(url_list)):
             url = url_list[idx]
             url_id = url_ids_list[idx]
 
             try:
                 engagement = response[url]['engagement']
-                self.post_social_signals(url_ids_list[idx], engagement['share_count'], engagement['comment_count'], engagement['reaction_count'])
+                signals.extend(self.generate_social_signals(url_id, engagement['share_count'], engagement['comment_count'], engagement['reaction_count']))
+                total_engagements[url_id] = engagement['share_count'] + engagement['comment_count'] + engagement['reaction_count']
             except Exception as e:
                 print(e)
 
+        signals = self.filter_changed_signals(signals)
+        if len(signals) > 0:
+            self.post_social_signals_batch(signals)
+
         today = datetime.now()
         expired_url_ids_list = [ str(id_str) for id_str, url, published_at in batch if (today - published_at).days > NewsArticleSocialSignalUpdater.URL_MAX_AGE_IN_DAYS ]
 
         self.set_flag(expired_url_ids_list, 3)
-        self.set_updated_at(url_ids_list, (today+timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'))
 
-        return False, x_app_usage, last_published_at
+        # Expired articles leave the queue, all others are scheduled again based on their age and engagement velocity
+        for url_id in expired_url_ids_list:
+            self.refresh_queue.remove(url_id)
+        for url_id in url_ids_list:
+            if url_id in self.refresh_queue:
+                self.refresh_queue.reschedule(url_id, total_engagements.get(url_id), now=today)
+        # Persist the rescheduled poll times, so that they survive a restart; expired articles keep the old default of one day
+        self.set_next_poll_times([ (url_id, self.refresh_queue.get_due_at(url_id) or today+timedelta(days=1)) for url_id in url_ids_list ])
+
+        return False
+
+
+    def wait_for_next_batch(self):
+        # Returns False if the queue is empty; otherwise waits for the next article to become due (or the next reload)
+        seconds_until_next_due = self.refresh_queue.seconds_until_next_due()
+        if seconds_until_next_due is None:
+            return False
+        sleep(min(seconds_until_next_due, NewsArticleSocialSignalUpdater.QUEUE_RELOAD_INTERVAL))
+        return True
+
+
+    def process_batch(self, min_date_str):
+        batch = self.pop_next_batch(min_date_str)
+
+        x_app_usage = {}
+
+        if len(batch) == 0:
+            return not self.wait_for_next_batch(), x_app_usage, None
+
+        _, _, last_published_at = batch[-1]
+
+        response, x_app_usage, error = self.request_share_data(batch)
+        done = self.handle_share_data(batch, response, x_app_usage, error)
+
+        return done, x_app_usage, last_published_at
 
 
     def process(self, min_date_str):
@@ -210,9 +367,47 @@ class NewsArticleSocialSignalUpdater:
             sys.stdout.write('Processing batch...')
             sys.stdout.flush()
             done, x_app_usage, last_published_at = self.process_batch(min_date_str)
-            sys.stdout.write('DONE ({}, {})\n'.format(str(x_app_usage), str(last_published_at)))
+            sys.stdout.write('DONE ({}, {}, {:.3f} req/s)\n'.format(str(x_app_usage), str(last_published_at), self.token_pool.rate()))
             sys.stdout.flush()
-            sleep(20)
+
+
+    def process_parallel(self, min_date_str, num_workers=None):
+        # Graph API requests run in a thread pool (spread over all tokens of the token pool); the refresh queue,
+        # the database and the API server are only accessed from this thread
+        if num_workers is None:
+            num_workers = NewsArticleSocialSignalUpdater.NUM_WORKERS
+
+        sys.stdout.write('Start fetching social signals for news articles ({}, {} workers, {} tokens)\n'.format(min_date_str, num_workers, len(self.token_pool)))
+        sys.stdout.flush()
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            pending = {}
+            done = False
+            while True:
+                while not done and len(pending) < num_workers:
+                    batch = self.pop_next_batch(min_date_str)
+                    if len(batch) == 0:
+                        break
+                    pending[pool.submit(self.request_share_data, batch)] = batch
+
+                if len(pending) == 0:
+                    if done or not self.wait_for_next_batch():
+                        break
+                    continue
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch = pending.pop(future)
+                    try:
+                        response, x_app_usage, error = future.result()
+                    except Exception as e:
+                        print("[Error] NewsArticleSocialSignalUpdater.process_parallel:", e)
+                        self.refresh_queue.requeue(batch)
+                        continue
+                    if self.handle_share_data(batch, response, x_app_usage, error):
+                        done = True
+                    sys.stdout.write('DONE ({}, {}, {:.3f} req/s)\n'.format(str(x_app_usage), str(batch[-1][2]), self.token_pool.rate()))
+                    sys.stdout.flush()
 
 
 
@@ -228,12 +423,15 @@ if  __name__ == '__main__':
     print(len(nass_updater.get_next_article_batch('2018-03-01')))
 
     if len(sys.argv) < 2:
-        print("Usage: python nassupdater.py <min-date-str>")
+        print("Usage: python nassupdater.py <min-date-str> [<num-workers>]")
         exit(0)
 
     min_date_str = sys.argv[1]
     print(min_date_str)
-    nass_updater.process(min_date_str)
+    if len(sys.argv) > 2:
+        nass_updater.process_parallel(min_date_str, num_workers=int(sys.argv[2]))
+    else:
+        nass_updater.process(min_date_str)
 
 
 ## But the number shown is the sum of:
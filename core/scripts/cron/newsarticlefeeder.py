@@ -23,12 +23,17 @@ Affect database tables:
 
 import sys
 import json
+import asyncio
+import aiohttp
 import requests
 import yaml
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
 from bson import ObjectId
 
+from apiclient import ApiClient
+from checkpointstore import CheckpointStore
+
 
 class NewsArticleFeeder:
 
@@ -46,6 +51,17 @@ class NewsArticleFeeder:
 
     PARAM_NAME__LATEST_FED_NEWS_ARTICLE_OID = 'latest_fed_news_article_oid'
 
+    # Maximum number of articles posted concurrently to the API in async mode
+    MAX_CONCURRENCY = 20
+
+    # Only the fields that are actually used are transferred from MongoDB
+    DOCUMENT_PROJECTION = { field: 1 for field in ['_id', 'title', 'text', 'url', 'labels', 'summary', 'top_image', 'published'] }
+    CURSOR_BATCH_SIZE = 200
+
+    # The checkpoint is saved locally after each document and sent to the API every CHECKPOINT_FLUSH_INTERVAL documents
+    CHECKPOINT_PATH = 'newsarticlefeeder.checkpoint.json'
+    CHECKPOINT_FLUSH_INTERVAL = 1000
+
     DOMAIN_MAPPING = {
         'not_applicable': 0,
         'health': 1,
@@ -62,6 +78,9 @@ class NewsArticleFeeder:
     def __init__(self):
         self.mongodb_client = MongoClient(host=NewsArticleFeeder.MONGODB_HOST)
         self.mongodb_name = self.mongodb_client[NewsArticleFeeder.MONGODB_NAME]
+        self.api_client = ApiClient(NewsArticleFeeder.API_URL__PROTECTED)
+        self.checkpoint = CheckpointStore(NewsArticleFeeder.CHECKPOINT_PATH, remote_setter=self.set_latest_oid, flush_interval=NewsArticleFeeder.CHECKPOINT_FLUSH_INTERVAL)
+        self.tail_failed = False
 
     def get_latest_oid(self):
         try:
@@ -85,67 +104,162 @@ class NewsArticleFeeder:
             print(e)
             return False
 
-    def fetch_batch(self, collection_name, limit=100):
-        min_oid = self.get_latest_oid()
+    def load_latest_oid(self):
+        # The local checkpoint is authoritative; the API is only asked if there is none yet
+        if self.checkpoint.get() is None:
+            latest_oid = self.get_latest_oid()
+            if latest_oid is not None and latest_oid != 0 and latest_oid != '0':
+                self.checkpoint.set(str(latest_oid))
+        return self.checkpoint.get()
+
+    def generate_query(self):
+        min_oid = self.load_latest_oid()
 
         if min_oid is None or min_oid == 0 or min_oid == '0':
             query = { "$and": [ { "labels" : { "$exists": True } } ] }
         else:
             query = { "$and": [ { "labels" : { "$exists": True } }, { '_id': {'$gt': ObjectId(min_oid)} } ] }
 
-        collection = self.mongodb_name[collection_name]
+        return query
 
-        latest_oid = None
+    def parse_document(self, doc):
+        # Returns the payloads for the article and its categories, or None if the document is not valid
+        title = doc['title']
+        text = doc['text']
+        url = doc['url']
+        labels = doc['labels']
+        summary = doc['summary']
 
-        cnt = 0
-        for doc in collection.find(query).limit(limit):
-            latest_oid = doc['_id']
-            title = doc['title']
-            text = doc['text']
-            url = doc['url']
-            labels = doc['labels']
-            summary = doc['summary']
-
-            top_image_url = ''
-            try:
-                top_image_url = doc['top_image']
-            except:
-                pass
+        top_image_url = ''
+        try:
+            top_image_url = doc['top_image']
+        except:
+            pass
 
-            try:
-                published = doc['published']
-                published_at = published.isoformat()
-            except:
-                continue
+        try:
+            published = doc['published']
+            published_at = published.isoformat()
+        except:
+            return None
 
-            if ',' in title:
-                title = ' '.join(title.split(',')[0:-1])
+        if ',' in title:
+            title = ' '.join(title.split(',')[0:-1])
 
-            article = {"published_at": published_at, "title": title, "url": url, "img_url": top_image_url, "content": text, "valid": 1}
+        article = {"published_at": published_at, "title": title, "url": url, "img_url": top_image_url, "content": text, "valid": 1}
 
-            label_list = []
-            if len(labels) == 0:
-                label_list.append("0")
-            else:
-                for l in labels:
-                    label_list.append("{}".format(NewsArticleFeeder.DOMAIN_MAPPING[l]))
+        label_list = []
+        if len(labels) == 0:
+            label_list.append("0")
+        else:
+            for l in labels:
+                label_list.append("{}".format(NewsArticleFeeder.DOMAIN_MAPPING[l]))
 
-            try:
-                r = requests.post('{}{}'.format(NewsArticleFeeder.API_URL__PROTECTED, NewsArticleFeeder.API_ENDPOINT__INSERT_NEWS_ARTICLE), json=article)
-                r = requests.post('{}{}'.format(NewsArticleFeeder.API_URL__PROTECTED, NewsArticleFeeder.API_ENDPOINT__PAGES_CATEGORIES), json={"url": url, "categories": ",".join(label_list)})
-            except Exception as e:
-                print("[ERROR] NewsArticleFeeder.fetch_batch:", e)
-            cnt += 1
+        categories = {"url": url, "categories": ",".join(label_list)}
+
+        return article, categories
+
+    @staticmethod
+    def is_article_stored(response):
+        # The API reports errors as JSON bodies (with HTTP status 200); an article that already exists counts as stored
+        return ApiClient.is_success(response) or (response is not None and response.get('name') == 'NewsArticleAlreadyExistsError')
+
+    def find_documents(self, collection, query, limit=0):
+        # Sorting on _id makes sure that all documents up to the checkpoint oid have been processed
+        return collection.find(query, projection=NewsArticleFeeder.DOCUMENT_PROJECTION).sort('_id', ASCENDING).batch_size(NewsArticleFeeder.CURSOR_BATCH_SIZE).limit(limit)
+
+    def post_document(self, payloads):
+        if payloads is None:
+            return True
+        article, categories = payloads
+        # The categories refer to the article, so they are only posted once the article has been stored
+        if not NewsArticleFeeder.is_article_stored(self.api_client.post(NewsArticleFeeder.API_ENDPOINT__INSERT_NEWS_ARTICLE, article)):
+            print("[ERROR] NewsArticleFeeder.post_document: article {} could not be stored".format(article['url']))
+            return False
+        if not ApiClient.is_success(self.api_client.post(NewsArticleFeeder.API_ENDPOINT__PAGES_CATEGORIES, categories)):
+            print("[ERROR] NewsArticleFeeder.post_document: categories of article {} could not be stored".format(article['url']))
+            return False
+        return True
+
+    def fetch_batch(self, collection_name, limit=100):
+        query = self.generate_query()
+
+        collection = self.mongodb_name[collection_name]
 
-        if latest_oid is not None:
-            self.set_latest_oid(latest_oid)
+        # The checkpoint only advances past documents that have been stored; everything from the first failure
+        # onwards is processed again in the next batch
+        cnt = 0
+        for doc in self.find_documents(collection, query, limit=limit):
+            if not self.post_document(self.parse_document(doc)):
+                break
+            self.checkpoint.set(str(doc['_id']))
+            cnt += 1
 
         if cnt > 0:
             return False
         else:
             return True
 
-    def fetch(self, collection_name, limit=1000):
+    async def _post_document(self, session, semaphore, payloads):
+        # Documents that are not valid are skipped, i.e., count as done
+        if payloads is None:
+            return True
+        article, categories = payloads
+        async with semaphore:
+            try:
+                # The categories refer to the article, so both requests are sent one after the other
+                async with session.post('{}{}'.format(NewsArticleFeeder.API_URL__PROTECTED, NewsArticleFeeder.API_ENDPOINT__INSERT_NEWS_ARTICLE), json=article) as r:
+                    if not NewsArticleFeeder.is_article_stored(json.loads(await r.text())):
+                        return False
+                async with session.post('{}{}'.format(NewsArticleFeeder.API_URL__PROTECTED, NewsArticleFeeder.API_ENDPOINT__PAGES_CATEGORIES), json=categories) as r:
+                    return ApiClient.is_success(json.loads(await r.text()))
+            except Exception as e:
+                print("[ERROR] NewsArticleFeeder._post_document:", e)
+                return False
+
+    async def _fetch_batch_async(self, collection_name, limit, max_concurrency):
+        query = self.generate_query()
+
+        collection = self.mongodb_name[collection_name]
+
+        oid_list, payloads_list = [], []
+        for doc in self.find_documents(collection, query, limit=limit):
+            oid_list.append(doc['_id'])
+            payloads_list.append(self.parse_document(doc))
+
+        if len(oid_list) == 0:
+            return True
+
+        # Only advance the checkpoint past the documents that -- together with all documents before them -- have been
+        # inserted successfully; everything after the first failure is processed again in the next batch
+        results = [None] * len(oid_list)
+        num_done = 0
+
+        async def post_and_advance(idx, session, semaphore, payloads):
+            nonlocal num_done
+            results[idx] = await self._post_document(session, semaphore, payloads)
+            while num_done < len(results) and results[num_done] is True:
+                self.checkpoint.set(str(oid_list[num_done]), auto_flush=False)
+                num_done += 1
+            # The remote checkpoint is updated with a blocking request, so not within the event loop
+            if self.checkpoint.flush_due():
+                await asyncio.get_running_loop().run_in_executor(None, self.checkpoint.flush)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*[ post_and_advance(idx, session, semaphore, payloads) for idx, payloads in enumerate(payloads_list) ])
+
+        if num_done == 0:
+            print("[ERROR] NewsArticleFeeder.fetch_batch_async: no progress (first document of batch failed)")
+            return True
+
+        return False
+
+    def fetch_batch_async(self, collection_name, limit=100, max_concurrency=None):
+        if max_concurrency is None:
+            max_concurrency = NewsArticleFeeder.MAX_CONCURRENCY
+        return asyncio.run(self._fetch_batch_async(collection_name, limit, max_concurrency))
+
+    def fetch(self, collection_name, limit=1000, use_async=False, max_concurrency=None):
         sys.stdout.write('Start fetching news articles\n')
         sys.stdout.flush()
         done = False
@@ -154,12 +268,75 @@ class NewsArticleFeeder:
             cnt += 1
             sys.stdout.write('Processing batch...')
             sys.stdout.flush()
-            done = self.fetch_batch(collection_name, limit=limit)
+            if use_async:
+                done = self.fetch_batch_async(collection_name, limit=limit, max_concurrency=max_concurrency)
+            else:
+                done = self.fetch_batch(collection_name, limit=limit)
             sys.stdout.write('DONE ({:,})\n'.format(limit*cnt))
             sys.stdout.flush()
+        self.checkpoint.flush()
+
+    def tail(self, collection_name):
+        # Long-running mode: process the whole backlog with a single cursor instead of re-querying per batch,
+        # then follow newly inserted or labelled documents with a change stream (requires a replica set). The
+        # stream is opened before the backlog scan, so that no document changed during the scan is missed.
+        query = self.generate_query()
+
+        collection = self.mongodb_name[collection_name]
+
+        sys.stdout.write('Start tailing news articles\n')
+        sys.stdout.flush()
+
+        min_oid = self.checkpoint.get()
+        start_oid = ObjectId(min_oid) if min_oid is not None else None
+        # Documents of the backlog that may show up again in the change stream
+        scanned_oids = set()
+        # Once a document could not be stored, the checkpoint stays before it (so that it is retried after a restart)
+        self.tail_failed = False
+        cnt = 0
+
+        pipeline = [ { '$match': { 'operationType': { '$in': ['insert', 'update', 'replace'] }, 'fullDocument.labels': { '$exists': True } } } ]
+        try:
+            with collection.watch(pipeline, full_document='updateLookup') as stream:
+                with collection.find(query, projection=NewsArticleFeeder.DOCUMENT_PROJECTION, no_cursor_timeout=True).sort('_id', ASCENDING).batch_size(NewsArticleFeeder.CURSOR_BATCH_SIZE) as cursor:
+                    for doc in cursor:
+                        self._tail_document(doc)
+                        scanned_oids.add(doc['_id'])
+                        cnt += 1
+                        if cnt % NewsArticleFeeder.CHECKPOINT_FLUSH_INTERVAL == 0:
+                            sys.stdout.write('DONE ({:,})\n'.format(cnt))
+                            sys.stdout.flush()
+
+                for change in stream:
+                    doc = change['fullDocument']
+                    # None if the document has been deleted in the meantime
+                    if doc is None:
+                        continue
+                    if (start_oid is not None and doc['_id'] <= start_oid) or doc['_id'] in scanned_oids:
+                        continue
+                    self._tail_document(doc)
+        finally:
+            self.checkpoint.flush()
+
+    def _tail_document(self, doc):
+        if not self.post_document(self.parse_document(doc)):
+            self.tail_failed = True
+            return
+        latest_oid = self.checkpoint.get()
+        if not self.tail_failed and (latest_oid is None or doc['_id'] > ObjectId(latest_oid)):
+            self.checkpoint.set(str(doc['_id']))
+
 
 if __name__ == '__main__':
 
     news_article_feeder = NewsArticleFeeder()
 
-    news_article_feeder.fetch('categorized_news')
+    if len(sys.argv) == 1:
+        news_article_feeder.fetch('categorized_news')
+    elif len(sys.argv) == 2 and sys.argv[1] == 'tail':
+        news_article_feeder.tail('categorized_news')
+    elif len(sys.argv) == 2:
+        news_article_feeder.fetch('categorized_news', use_async=True, max_concurrency=int(sys.argv[1]))
+    else:
+        print("Usage: python newsarticlefeeder.py [<max-concurrency> | tail]")
+        exit(0)
@@ -0,0 +1,85 @@
+'''
+AppUsageRateLimiter
+
+Token bucket for requests to the Facebook Graph API whose refill rate adapts to the
+application usage the API reports in the x-app-usage header of each response, e.g.:
+
+  {"call_count": 28, "total_time": 25, "total_cputime": 25}
+
+All three values are percentages of the application's rate limit; requests get throttled
+once one of them reaches 100. The rate is scaled between min_rate and max_rate with the
+remaining headroom below target_usage (smoothed, to avoid oscillation), so that requests
+are sent faster when there is quota left and slow down well before the limit is reached.
+
+'''
+
+
+import time
+
+
+class AppUsageRateLimiter:
+
+    USAGE_KEYS = ['call_count', 'total_time', 'total_cputime']
+
+    # Rates are in requests per second
+    MIN_RATE = 1/300
+    MAX_RATE = 1.0
+    INITIAL_RATE = 1/20
+    TARGET_USAGE = 80
+
+    def __init__(self, min_rate=None, max_rate=None, initial_rate=None, target_usage=None, smoothing=0.5, burst=1, sleep=time.sleep, clock=time.monotonic):
+        self.min_rate = min_rate if min_rate is not None else AppUsageRateLimiter.MIN_RATE
+        self.max_rate = max_rate if max_rate is not None else AppUsageRateLimiter.MAX_RATE
+        self.rate = initial_rate if initial_rate is not None else AppUsageRateLimiter.INITIAL_RATE
+        self.target_usage = target_usage if target_usage is not None else AppUsageRateLimiter.TARGET_USAGE
+        self.smoothing = smoothing
+        self.burst = burst
+        self.sleep = sleep
+        self.clock = clock
+        self.tokens = burst
+        self.last_refill = clock()
+        self.usage = 0
+
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+
+    def wait_time(self):
+        # Seconds until the next request may be sent
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+    def reserve(self):
+        # Reserve the next request and return the number of seconds to wait before sending it;
+        # tokens may become negative, so that concurrent callers queue up behind each other
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+    def acquire(self):
+        # Block until a request may be sent
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+
+
+    def update(self, x_app_usage):
+        if not x_app_usage:
+            return
+        self.usage = max([ x_app_usage.get(key, 0) for key in AppUsageRateLimiter.USAGE_KEYS ])
+        headroom = min(1.0, max(0.0, (self.target_usage - self.usage) / self.target_usage))
+        target_rate = self.min_rate + (self.max_rate - self.min_rate) * headroom
+        self._refill()
+        self.rate = self.smoothing * target_rate + (1 - self.smoothing) * self.rate
+
+
+    def throttle(self):
+        # Called when the API reports that the limit has been reached anyway
+        self._refill()
+        self.rate = self.min_rate
+        self.tokens = 0
@@ -0,0 +1,111 @@
+'''
+RefreshQueue
+
+In-memory priority queue (heap) that decides when the social signals of a news article
+should be polled next. Articles are loaded once and then rescheduled after each poll:
+the refresh interval grows with the age of an article and shrinks with its engagement
+velocity (change in total engagement per hour since the last poll), so that fresh,
+fast-moving articles are polled more often than old articles nobody reacts to anymore.
+
+'''
+
+
+import heapq
+
+from datetime import datetime, timedelta
+
+
+class RefreshQueue:
+
+    # Refresh intervals in hours
+    BASE_INTERVAL = 6
+    MIN_INTERVAL = 1
+    MAX_INTERVAL = 48
+    # Age (in hours) at which the interval is doubled, velocity (engagements per hour) at which it is halved
+    AGE_SCALE = 48
+    VELOCITY_SCALE = 10
+
+    def __init__(self):
+        self.heap = []
+        self.articles = {}      # url_id => (url, published_at, total engagement, time of last poll)
+        self.due = {}           # url_id => time of the next poll
+        self.counter = 0        # Tie-breaker for entries with the same due time
+
+
+    def __len__(self):
+        return len(self.articles)
+
+
+    def __contains__(self, url_id):
+        return url_id in self.articles
+
+
+    def push(self, url_id, url, published_at, due_at, engagement=None, polled_at=None):
+        self.articles[url_id] = (url, published_at, engagement, polled_at)
+        self.due[url_id] = due_at
+        # Fresher articles come first among articles that are due at the same time
+        heapq.heappush(self.heap, (due_at, -published_at.timestamp(), self.counter, url_id))
+        self.counter += 1
+
+
+    def pop_due(self, limit, now=None):
+        # Returns up to limit (url_id, url, published_at) tuples that are due for polling
+        if now is None:
+            now = datetime.now()
+        batch = []
+        while len(self.heap) > 0 and len(batch) < limit and self.heap[0][0] <= now:
+            _, _, _, url_id = heapq.heappop(self.heap)
+            if url_id not in self.articles:
+                continue
+            url, published_at, _, _ = self.articles[url_id]
+            batch.append((url_id, url, published_at))
+        return batch
+
+
+    def get_due_at(self, url_id):
+        return self.due.get(url_id)
+
+
+    def seconds_until_next_due(self, now=None):
+        if len(self.heap) == 0:
+            return None
+        if now is None:
+            now = datetime.now()
+        return max(0.0, (self.heap[0][0] - now).total_seconds())
+
+
+    def requeue(self, batch, now=None):
+        # Put articles back that could not be polled
+        if now is None:
+            now = datetime.now()
+        for url_id, url, published_at in batch:
+            _, _, engagement, polled_at = self.articles[url_id]
+            self.push(url_id, url, published_at, now, engagement=engagement, polled_at=polled_at)
+
+
+    def reschedule(self, url_id, engagement=None, now=None):
+        # engagement is None if no (new) value could be retrieved
+        if now is None:
+            now = datetime.now()
+        url, published_at, last_engagement, last_polled_at = self.articles[url_id]
+        if engagement is None:
+            engagement = last_engagement if last_engagement is not None else 0
+
+        velocity = 0.0
+        if last_engagement is not None and last_polled_at is not None:
+            hours = max((now - last_polled_at).total_seconds() / 3600, 1/60)
+            velocity = max(0, engagement - last_engagement) / hours
+
+        self.push(url_id, url, published_at, now + timedelta(hours=self.next_interval(now - published_at, velocity)), engagement=engagement, polled_at=now)
+
+
+    def remove(self, url_id):
+        # Entries left in the heap are skipped lazily
+        self.articles.pop(url_id, None)
+        self.due.pop(url_id, None)
+
+
+    def next_interval(self, age, velocity):
+        age_in_hours = max(0, age.total_seconds() / 3600)
+        interval = RefreshQueue.BASE_INTERVAL * (1 + age_in_hours / RefreshQueue.AGE_SCALE) / (1 + velocity / RefreshQueue.VELOCITY_SCALE)
+        return min(RefreshQueue.MAX_INTERVAL, max(RefreshQueue.MIN_INTERVAL, interval))
@@ -1,16 +1,33 @@
+import os
+import re
 import sys
-import json
+import heapq
+import threading
+import multiprocessing
 import requests
-import numpy as np
 
 import pymysql.cursors
 import pymysql
 import datetime
 import yaml
 
-import pandas as pd
 import spacy
 
+# nlp.pipe(..., n_process=...) has been added in spaCy 2.2.2
+SPACY_MIN_VERSION = (2, 2, 2)
+# Major, minor and patch level, e.g., "2.2.2.dev0" => (2, 2, 2), "3.0.0rc1" => (3, 0, 0)
+SPACY_VERSION = tuple(int(part) for part in re.match(r"(\d+)\.(\d+)(?:\.(\d+))?", spacy.__version__).groups('0'))
+
+if SPACY_VERSION < SPACY_MIN_VERSION:
+    raise ImportError("TermCountGenerator requires spaCy >= {} (found {})".format('.'.join(map(str, SPACY_MIN_VERSION)), spacy.__version__))
+
+from operator import itemgetter
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from apiclient import ApiClient
+from termcountstore import TermCountStore
+
 
 class TermCountGenerator:
 
@@ -27,20 +44,80 @@ class TermCountGenerator:
     API_URL__PROTECTED = config['url']['api_server']
 
     API_ENDPOINT__POST_TOPWORDS = 'newsarticles/topwords/daily/'
-
-    def __init__(self):
-        self.db = pymysql.connect(host=TermCountGenerator.MYSQL_HOST,
-                                  user=TermCountGenerator.MYSQL_USER,
-                                  password=TermCountGenerator.MYSQL_PASSWORD,
-                                  db=TermCountGenerator.MYSQL_DB,
-                                  charset='utf8mb4',
-                                  cursorclass=pymysql.cursors.DictCursor)
-        self.nlp = spacy.load('en')
+    API_ENDPOINT__POST_TOPWORDS_BATCH = 'newsarticles/topwords/daily/batch/'
+
+    # Number of (date, source, category) batches per request to the batch endpoint
+    TOPWORDS_BATCH_SIZE = 50
+
+    # Number of article ids per Solr request and fields to fetch
+    SOLR_BATCH_SIZE = 200
+    SOLR_FIELDS = 'id,title,content'
+
+    # Only the tagger is needed for POS-filtered term counting (token.is_stop is lexical);
+    # spacy.load(..., disable=...) requires spaCy >= 2.0, nlp.pipe(..., n_process=...) spaCy >= 2.2.2
+    SPACY_DISABLED_PIPES = ['parser', 'ner']
+    # Number of texts buffered per spaCy batch and number of worker processes used by nlp.pipe
+    NLP_BATCH_SIZE = 64
+    NLP_N_PROCESS = 1
+
+    CATEGORIES = range(1, 6)  # for GRR support
+    VALID_POS_TAGS = ['NOUN', 'PROPN']
+
+    # Defaults for run_parallel(): I/O threads (MySQL, Solr, API) and NLP worker processes
+    NUM_IO_WORKERS = 4
+    NUM_NLP_WORKERS = os.cpu_count() or 1
+    # NLP workers are started lazily, i.e., once the I/O threads are running; forking a process with running threads
+    # (which may hold locks) and an open MySQL connection can deadlock, so workers are started from a fork server
+    NLP_WORKER_START_METHOD = 'forkserver'
+
+    # Local store of the token counts of each article and of already submitted batches
+    TERM_COUNT_STORE_PATH = 'termcountgenerator.sqlite'
+
+    def __init__(self, nlp_batch_size=None, nlp_n_process=None):
+        # MySQL connections and HTTP sessions are not thread-safe, so each thread gets its own
+        self.local = threading.local()
+        self._store = None
+        self.nlp = spacy.load('en', disable=TermCountGenerator.SPACY_DISABLED_PIPES)
+        self.nlp_batch_size = nlp_batch_size if nlp_batch_size is not None else TermCountGenerator.NLP_BATCH_SIZE
+        self.nlp_n_process = nlp_n_process if nlp_n_process is not None else TermCountGenerator.NLP_N_PROCESS
+
+
+    @property
+    def db(self):
+        if not hasattr(self.local, 'db'):
+            self.local.db = pymysql.connect(host=TermCountGenerator.MYSQL_HOST,
+                                            user=TermCountGenerator.MYSQL_USER,
+                                            password=TermCountGenerator.MYSQL_PWD,
+                                            db=TermCountGenerator.MYSQL_DBNAME,
+                                            charset='utf8mb4',
+                                            cursorclass=pymysql.cursors.DictCursor)
+        return self.local.db
+
+    @property
+    def store(self):
+        # Only used from the main thread
+        if self._store is None:
+            self._store = TermCountStore(TermCountGenerator.TERM_COUNT_STORE_PATH)
+        return self._store
+
+    @property
+    def api_client(self):
+        # Used by the I/O threads of run_parallel(), so one client (and requests.Session) per thread
+        if not hasattr(self.local, 'api_client'):
+            self.local.api_client = ApiClient(TermCountGenerator.API_URL__PROTECTED)
+        return self.local.api_client
+
+    @property
+    def session(self):
+        # Reuse connections to Solr across requests (keep-alive)
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
 
 
     def get_document_solr(self, article_id):
         try:
-            r = requests.get("{}/rpm_news/select?q=id:{}&wt=json".format(TermCountGenerator.BASE_URL__SOLR, article_id))
+            r = self.session.get("{}/rpm_news/select".format(TermCountGenerator.BASE_URL__SOLR), params={'q': 'id:{}'.format(article_id), 'fl': TermCountGenerator.SOLR_FIELDS, 'wt': 'json'})
             return r.json()['response']['docs'][0]
         except Exception as e:
             print("[get_document_solr]")
@@ -49,58 +126,145 @@ class TermCountGenerator:
             print(e)
             return None
 
+    def get_documents_solr(self, id_list):
+        # Fetch several documents with a single request; the terms query parser avoids the limit
+        # on boolean clauses of "id:(a OR b OR ...)", and POST avoids overly long URLs
+        try:
+            params = {'q': '{{!terms f=id}}{}'.format(','.join(map(str, id_list))), 'fl': TermCountGenerator.SOLR_FIELDS, 'rows': len(id_list), 'wt': 'json'}
+            r = self.session.post("{}/rpm_news/select".format(TermCountGenerator.BASE_URL__SOLR), data=params)
+            return r.json()['response']['docs']
+        except Exception as e:
+            print("[get_documents_solr]")
+            print(e)
+            return None
+
+    def iter_document_pages(self, id_list, batch_size=None):
+        if batch_size is None:
+            batch_size = TermCountGenerator.SOLR_BATCH_SIZE
+        if id_list is None:
+            return
+        for start in range(0, len(id_list), batch_size):
+            documents = self.get_documents_solr(id_list[start:start+batch_size])
+            if documents is not None:
+                yield documents
+
+    def iter_documents(self, id_list, batch_size=None):
+        for documents in self.iter_document_pages(id_list, batch_size=batch_size):
+            for doc in documents:
+                yield doc
+
     def get_documents(self, id_list):
-        documents = []
-        for doc_id in id_list:
-            doc = self.get_document_solr(doc_id)
-            if doc is not None:
-                documents.append(doc)
-        return documents
+        return list(self.iter_documents(id_list))
 
 
-    def get_ids_for_batch(self, day, source, category):
+    def get_ids_for_day(self, day, sources_list=None, categories=None):
+        # Fetch the article ids of all (source, category) batches of a day with a single range query
+        # (no DATE() around published_at so that an index on it can be used); rows are streamed
+        # with an unbuffered cursor and grouped into a dictionary with (source, category) as key
+        if categories is None:
+            categories = TermCountGenerator.CATEGORIES
+        sources_set = set(sources_list) if sources_list is not None else None
         try:
-            id_list = []
-            with self.db.cursor() as cursor:
-                sql = "SELECT a.id FROM rpm_news_articles a, rpm_pages_categories_grr c WHERE a.id = c.url_id AND DATE(a.published_at)=TIMESTAMP('{}') AND a.source={} AND c.category={}".format(day, source, category)
+            id_lists = {}
+            with self.db.cursor(pymysql.cursors.SSDictCursor) as cursor:
+                sql = "SELECT a.id, a.source, c.category FROM rpm_news_articles a, rpm_pages_categories_grr c WHERE a.id = c.url_id AND a.published_at >= TIMESTAMP('{}') AND a.published_at < TIMESTAMP('{}') + INTERVAL 1 DAY AND c.category IN ({})".format(day, day, ','.join(map(str, categories)))
                 cursor.execute(sql)
-                for row in cursor.fetchall():
-                    id_list.append(row['id'])
-            return id_list
+                for row in cursor:
+                    if sources_set is not None and row['source'] not in sources_set:
+                        continue
+                    id_lists.setdefault((row['source'], row['category']), []).append(row['id'])
+            return id_lists
         except Exception as e:
-            print("[get_ids_for_batch]")
+            print("[get_ids_for_day]")
             print(e)
             return None
 
 
-    def generate_batch_document(self, documents, remove_stopwords=True, title_weight=2, valid_pos_tags=None):
-        word_list = []
+    def iter_cells(self, dates_list, sources_list):
+        # Yield all (date, source, category) cells together with their article ids, one query per date
+        for date in dates_list:
+            id_lists = self.get_ids_for_day(date, sources_list=sources_list)
+            if id_lists is None:
+                id_lists = {}
+            for source in sources_list:
+                for category in TermCountGenerator.CATEGORIES:
+                    yield (date, source, category), id_lists.get((source, category), [])
+
+
+    def iter_batch_texts(self, documents, title_weight=2):
         for d in documents:
-            document = "{} {}".format((d['title'] + ". ")*title_weight, d['content'])
-            doc = self.nlp(document)
-            for token in doc:
-                if valid_pos_tags is not None and token.pos_ not in valid_pos_tags:
-                    continue
-                if remove_stopwords is True and token.is_stop == True:
-                    continue
-                word_list.append(token.text.lower())
-        return word_list
-
-
-    def generate_word_count_dict(self, word_list, limit=200):
+            yield "{} {}".format((d['title'] + ". ")*title_weight, d['content'])
+
+
+    def iter_document_tokens(self, documents, remove_stopwords=True, title_weight=2, valid_pos_tags=None):
+        # Yields one token generator per document
+        texts = self.iter_batch_texts(documents, title_weight=title_weight)
+        for doc in self.nlp.pipe(texts, batch_size=self.nlp_batch_size, n_process=self.nlp_n_process):
+            yield self.iter_tokens(doc, remove_stopwords=remove_stopwords, valid_pos_tags=valid_pos_tags)
+
+
+    def iter_tokens(self, doc, remove_stopwords=True, valid_pos_tags=None):
+        for token in doc:
+            if valid_pos_tags is not None and token.pos_ not in valid_pos_tags:
+                continue
+            if remove_stopwords is True and token.is_stop == True:
+                continue
+            yield token.text.lower()
+
+
+    def generate_article_word_counts(self, documents, remove_stopwords=True, title_weight=2, valid_pos_tags=None):
+        # Tokens are counted as they come out of the tokenizer, without collecting them first
+        return [ Counter(tokens) for tokens in self.iter_document_tokens(documents, remove_stopwords=remove_stopwords, title_weight=title_weight, valid_pos_tags=valid_pos_tags) ]
+
+
+    def generate_batch_word_counts(self, documents, remove_stopwords=True, title_weight=2, valid_pos_tags=None):
+        word_counts = Counter()
+        for tokens in self.iter_document_tokens(documents, remove_stopwords=remove_stopwords, title_weight=title_weight, valid_pos_tags=valid_pos_tags):
+            word_counts.update(tokens)
+        return word_counts
+
+
+    @staticmethod
+    def merge_word_counts(word_counts_list):
+        # Merge partial counts, e.g., of individual articles or from parallel workers
+        word_counts = Counter()
+        for counts in word_counts_list:
+            word_counts.update(counts)
+        return word_counts
+
+
+    def generate_word_count_dict(self, word_counts, limit=200):
+        # Top-k selection with a heap of size limit instead of sorting all words
         word_count_dict = {}
-        for word, count in pd.Series(word_list).value_counts().head(limit).iteritems():
+        for word, count in heapq.nlargest(limit, word_counts.items(), key=itemgetter(1)):
             word_count_dict[word] = count
         return word_count_dict
 
 
+    def prepare_batch(self, documents):
+        # Split the documents of a batch into those with up-to-date counts in the store and those
+        # that need to be tokenized
+        article_hashes = { str(d['id']): TermCountStore.content_hash(d) for d in documents }
+        cached_counts = self.store.get_counts(article_hashes)
+        new_documents = [ d for d in documents if str(d['id']) not in cached_counts ]
+        return article_hashes, cached_counts, new_documents
+
+
+    def merge_batch_counts(self, article_hashes, cached_counts, new_documents, new_counts):
+        self.store.put_counts([ (str(d['id']), article_hashes[str(d['id'])], counts) for d, counts in zip(new_documents, new_counts) ])
+        return TermCountGenerator.merge_word_counts(list(cached_counts.values()) + new_counts)
+
+
     def submit_top_words(self, date, source, category, word_counts):
-        try:
-            data = {"published_at": date, "source": source, "category": category, "data": word_counts }
-            r = requests.post('{}{}'.format(TermCountGenerator.API_URL__PROTECTED, TermCountGenerator.API_ENDPOINT__POST_TOPWORDS), json=data)
-            response = json.loads(r.text)
-        except Exception as e:
-            print("[submit_top_words]" + str(e))
+        data = {"published_at": date, "source": source, "category": category, "data": word_counts }
+        response = self.api_client.post(TermCountGenerator.API_ENDPOINT__POST_TOPWORDS, data)
+        return ApiClient.is_success(response)
+
+
+    def submit_top_words_batch(self, top_words_list):
+        # top_words_list: list of (date, source, category, word_counts) tuples
+        data = [ {"published_at": date, "source": source, "category": category, "data": word_counts } for date, source, category, word_counts in top_words_list ]
+        return self.api_client.post_batch(TermCountGenerator.API_ENDPOINT__POST_TOPWORDS_BATCH, data, batch_size=TermCountGenerator.TOPWORDS_BATCH_SIZE)
 
 
     def get_sources(self, min_doc_count=1000):
@@ -126,23 +290,139 @@ class TermCountGenerator:
         sources_list = self.get_sources()
 
         for date in dates_list:
+            id_lists = self.get_ids_for_day(date, sources_list=sources_list)
+            if id_lists is None:
+                id_lists = {}
+            # Top words of all batches of the day are submitted together
+            top_words_list, batch_hashes = [], []
             # for source in ['1136264918', '2318860610', '4035711312', '2027664695', '971732516 ']:
             for source in sources_list:
                 # for category in range(1,9):
-                for category in range(1, 6):  # for GRR support
-                    id_list = self.get_ids_for_batch(date, source, category)
+                for category in TermCountGenerator.CATEGORIES:
+                    id_list = id_lists.get((source, category), [])
                     batch_documents = self.get_documents(id_list)
-                    word_list = self.generate_batch_document(batch_documents, valid_pos_tags=['NOUN', 'PROPN'])
-                    word_counts = self.generate_word_count_dict(word_list)
+                    article_hashes, cached_counts, new_documents = self.prepare_batch(batch_documents)
+                    # Skip batches that have been submitted before and whose articles have not changed since
+                    batch_hash = TermCountStore.batch_hash(article_hashes)
+                    if self.store.is_submitted(date, source, category, batch_hash):
+                        continue
+                    new_counts = self.generate_article_word_counts(new_documents, valid_pos_tags=TermCountGenerator.VALID_POS_TAGS)
+                    word_counts = self.generate_word_count_dict(self.merge_batch_counts(article_hashes, cached_counts, new_documents, new_counts))
                     if len(word_counts) == 0:
                         continue
                     #print(date, source, category, word_counts)
-                    self.submit_top_words(date, source, category, word_counts)
+                    top_words_list.append((date, source, category, word_counts))
+                    batch_hashes.append(batch_hash)
+
+            if self.submit_top_words_batch(top_words_list):
+                for (date, source, category, _), batch_hash in zip(top_words_list, batch_hashes):
+                    self.store.mark_submitted(date, source, category, batch_hash)
 
             time_elapsed = datetime.datetime.now() - start_time
             print("{} [{}]".format(date, time_elapsed))
 
 
+    def run_parallel(self, start_date, end_date, num_io_workers=None, num_nlp_workers=None, max_cells_in_flight=None):
+        # Each (date, source, category) cell goes through three stages: fetching the documents (thread pool),
+        # counting the terms of new or changed articles (process pool) and submitting the top words (thread pool);
+        # the term count store is only accessed from this thread. Top words are submitted to the batch endpoint
+        # TOPWORDS_BATCH_SIZE cells at a time (or as soon as no cell is being fetched or counted anymore). At most
+        # max_cells_in_flight cells are being fetched or counted at any time, which bounds memory usage; a cell
+        # waiting to be submitted only keeps its top words and no longer counts against this limit.
+        if num_io_workers is None:
+            num_io_workers = TermCountGenerator.NUM_IO_WORKERS
+        if num_nlp_workers is None:
+            num_nlp_workers = TermCountGenerator.NUM_NLP_WORKERS
+        if max_cells_in_flight is None:
+            max_cells_in_flight = 2 * (num_io_workers + num_nlp_workers)
+
+        start_time = datetime.datetime.now()
+        dates_list = self.generate_dates(start_date, end_date)
+        sources_list = self.get_sources()
+
+        cells = self.iter_cells(dates_list, sources_list)
+        num_cells = len(dates_list) * len(sources_list) * len(TermCountGenerator.CATEGORIES)
+        num_cells_done = 0
+
+        with ThreadPoolExecutor(max_workers=num_io_workers) as io_pool, \
+             ProcessPoolExecutor(max_workers=num_nlp_workers, mp_context=multiprocessing.get_context(TermCountGenerator.NLP_WORKER_START_METHOD),
+                                 initializer=_init_term_count_worker, initargs=(self.nlp_batch_size,)) as nlp_pool:
+
+            pending = {}
+            doc_counts = {}
+            batch_states = {}
+            ready = []      # (cell, word_counts) tuples waiting to be submitted together
+
+            def submit_next_cell():
+                cell, id_list = next(cells, (None, None))
+                if cell is not None:
+                    pending[io_pool.submit(self.get_documents, id_list)] = ('fetch', cell)
+
+            def submit_ready_cells():
+                top_words_list = [ (*cell, word_counts) for cell, word_counts in ready ]
+                pending[io_pool.submit(self.submit_top_words_batch, top_words_list)] = ('submit', [ cell for cell, _ in ready ])
+                del ready[:]
+
+            def finish_cell(cell, free_slot=True):
+                # Cell is done, either submitted, unchanged or nothing to submit; submitted cells have already
+                # freed their slot when they became ready
+                nonlocal num_cells_done
+                batch_states.pop(cell, None)
+                num_cells_done += 1
+                time_elapsed = datetime.datetime.now() - start_time
+                num_documents, num_new_documents = doc_counts.pop(cell, (0, 0))
+                print("{} {} {}: {} documents, {} tokenized ({}/{}) [{}]".format(*cell, num_documents, num_new_documents, num_cells_done, num_cells, time_elapsed))
+                if free_slot:
+                    submit_next_cell()
+
+            for _ in range(max_cells_in_flight):
+                submit_next_cell()
+
+            while len(pending) > 0 or len(ready) > 0:
+                # Submit a partial batch once no more cells are coming (all remaining ones are being submitted)
+                if len(ready) > 0 and all([ stage == 'submit' for stage, _ in pending.values() ]):
+                    submit_ready_cells()
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, cell = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print("[run_parallel] {} {}: {}".format(stage, cell, e))
+                        result = None
+
+                    if stage == 'submit':
+                        # cell is the list of cells submitted together
+                        for submitted_cell in cell:
+                            if result:
+                                self.store.mark_submitted(*submitted_cell, batch_states[submitted_cell][0])
+                            finish_cell(submitted_cell, free_slot=False)
+                        continue
+
+                    if stage == 'fetch' and result:
+                        article_hashes, cached_counts, new_documents = self.prepare_batch(result)
+                        doc_counts[cell] = (len(result), len(new_documents))
+                        batch_hash = TermCountStore.batch_hash(article_hashes)
+                        if not self.store.is_submitted(*cell, batch_hash):
+                            batch_states[cell] = (batch_hash, article_hashes, cached_counts, new_documents)
+                            pending[nlp_pool.submit(_count_article_terms, new_documents, TermCountGenerator.VALID_POS_TAGS)] = ('count', cell)
+                            continue
+                    elif stage == 'count' and result is not None:
+                        _, article_hashes, cached_counts, new_documents = batch_states[cell]
+                        word_counts = self.generate_word_count_dict(self.merge_batch_counts(article_hashes, cached_counts, new_documents, result))
+                        if len(word_counts) > 0:
+                            # Only the batch hash is needed from here on, the documents can be freed
+                            batch_states[cell] = (batch_states[cell][0], None, None, None)
+                            ready.append((cell, word_counts))
+                            if len(ready) >= TermCountGenerator.TOPWORDS_BATCH_SIZE:
+                                submit_ready_cells()
+                            submit_next_cell()
+                            continue
+
+                    finish_cell(cell)
+
+
     def generate_start_end_dates(self, start_date_str=None, end_date_str=None):
         if start_date_str is None:
             start_date = datetime.datetime.today()
@@ -159,16 +439,34 @@ class TermCountGenerator:
 
 
 
+# Process pool workers: each worker process loads its own spaCy model once
+
+_term_count_worker = None
+
+
+def _init_term_count_worker(nlp_batch_size):
+    global _term_count_worker
+    _term_count_worker = TermCountGenerator(nlp_batch_size=nlp_batch_size, nlp_n_process=1)
+
+
+def _count_article_terms(documents, valid_pos_tags):
+    return _term_count_worker.generate_article_word_counts(documents, valid_pos_tags=valid_pos_tags)
+
+
+
 if __name__ == '__main__':
 
     term_count_generator = TermCountGenerator()
 
     if len(sys.argv) == 1:
         start_date, end_date = term_count_generator.generate_start_end_dates()
-    elif len(sys.argv) == 3:
+    elif len(sys.argv) in [3, 4]:
         start_date, end_date = term_count_generator.generate_start_end_dates(start_date_str=sys.argv[1], end_date_str=sys.argv[2])
     else:
-        print("Usage: python termcountgenerator.py <start-date-str> <end-date-str>")
+        print("Usage: python termcountgenerator.py <start-date-str> <end-date-str> [<num-nlp-workers>]")
         exit(0)
 
-    term_count_generator.run(start_date, end_date)
+    if len(sys.argv) == 4:
+        term_count_generator.run_parallel(start_date, end_date, num_nlp_workers=int(sys.argv[3]))
+    else:
+        term_count_generator.run(start_date, end_date)
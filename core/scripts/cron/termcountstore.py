@@ -0,0 +1,80 @@
+'''
+TermCountStore
+
+Local SQLite store used by TermCountGenerator to remember the token counts of each
+news article (keyed by article id and a hash of its title and content) as well as
+the (date, source, category) batches that have already been submitted to the API.
+
+This allows the term counts of a batch to be rebuilt by summing the cached counts of
+its articles, so that only new or changed articles need to be tokenized, and a crashed
+or repeated run to skip all batches that have not changed since their last submission.
+
+'''
+
+
+import json
+import hashlib
+import sqlite3
+
+from collections import Counter
+
+
+class TermCountStore:
+
+    # SQLite limits the number of host parameters per statement
+    MAX_QUERY_PARAMS = 500
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS article_counts (article_id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, counts TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS submitted_batches (published_at TEXT NOT NULL, source TEXT NOT NULL, category INTEGER NOT NULL, batch_hash TEXT NOT NULL, PRIMARY KEY (published_at, source, category))")
+        self.db.commit()
+
+
+    @staticmethod
+    def content_hash(document):
+        return hashlib.sha1("{}\n{}".format(document['title'], document['content']).encode('utf-8')).hexdigest()
+
+
+    @staticmethod
+    def batch_hash(article_hashes):
+        # article_hashes: dictionary article id => content hash
+        h = hashlib.sha1()
+        for article_id in sorted(article_hashes):
+            h.update("{}:{};".format(article_id, article_hashes[article_id]).encode('utf-8'))
+        return h.hexdigest()
+
+
+    def get_counts(self, article_hashes):
+        # Return the cached counts (as Counter) of all articles whose content hash has not changed
+        counts = {}
+        article_ids = [ str(article_id) for article_id in article_hashes ]
+        expected_hashes = { str(article_id): content_hash for article_id, content_hash in article_hashes.items() }
+        for start in range(0, len(article_ids), TermCountStore.MAX_QUERY_PARAMS):
+            chunk = article_ids[start:start+TermCountStore.MAX_QUERY_PARAMS]
+            sql = "SELECT article_id, content_hash, counts FROM article_counts WHERE article_id IN ({})".format(','.join(['?'] * len(chunk)))
+            for article_id, content_hash, counts_json in self.db.execute(sql, chunk):
+                if expected_hashes[article_id] == content_hash:
+                    counts[article_id] = Counter(json.loads(counts_json))
+        return counts
+
+
+    def put_counts(self, entries):
+        # entries: list of (article id, content hash, counts) tuples
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO article_counts (article_id, content_hash, counts) VALUES (?, ?, ?)",
+                                [ (str(article_id), content_hash, json.dumps(counts)) for article_id, content_hash, counts in entries ])
+
+
+    def is_submitted(self, date, source, category, batch_hash):
+        row = self.db.execute("SELECT batch_hash FROM submitted_batches WHERE published_at = ? AND source = ? AND category = ?", (date, str(source), category)).fetchone()
+        return row is not None and row[0] == batch_hash
+
+
+    def mark_submitted(self, date, source, category, batch_hash):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO submitted_batches (published_at, source, category, batch_hash) VALUES (?, ?, ?, ?)", (date, str(source), category, batch_hash))
+
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,88 @@
+'''
+TokenPool
+
+Set of Facebook app access tokens shared by several worker threads. Each token has its own
+request budget, an AppUsageRateLimiter driven by the x-app-usage header of the responses
+to requests made with it. Workers always get the token that allows the next request the
+soonest, and a token can be refreshed without blocking the workers using the other tokens.
+
+'''
+
+
+import threading
+
+from time import sleep
+
+from ratelimiter import AppUsageRateLimiter
+
+
+class TokenSlot:
+
+    def __init__(self, access_token, app_id, app_secret):
+        self.access_token = access_token
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.rate_limiter = AppUsageRateLimiter()
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+
+class TokenPool:
+
+    def __init__(self, apps, token_refresher):
+        # apps: list of dictionaries with access_token, app_id and app_secret
+        # token_refresher: function (app_id, app_secret) => new access token
+        self.slots = [ TokenSlot(app['access_token'], app['app_id'], app['app_secret']) for app in apps ]
+        self.token_refresher = token_refresher
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.slots)
+
+
+    def acquire(self):
+        # Returns the slot and its current access token once the slot's budget allows a request
+        with self.lock:
+            candidates = [ slot for slot in self.slots if not slot.refreshing ] or self.slots
+            slot = min(candidates, key=lambda slot: slot.rate_limiter.wait_time())
+            wait = slot.rate_limiter.reserve()
+            access_token = slot.access_token
+        if wait > 0:
+            sleep(wait)
+        return slot, access_token
+
+
+    def update(self, slot, x_app_usage):
+        with self.lock:
+            slot.rate_limiter.update(x_app_usage)
+
+
+    def throttle(self, slot):
+        with self.lock:
+            slot.rate_limiter.throttle()
+
+
+    def refresh(self, slot, stale_access_token):
+        # Only the first worker that reports a problem with a token refreshes it
+        with slot.lock:
+            if slot.access_token != stale_access_token:
+                return slot.access_token
+            with self.lock:
+                slot.refreshing = True
+            try:
+                access_token = self.token_refresher(slot.app_id, slot.app_secret)
+                with self.lock:
+                    slot.access_token = access_token
+            except Exception as e:
+                print("[ERROR] TokenPool.refresh:", e)
+            finally:
+                with self.lock:
+                    slot.refreshing = False
+            return slot.access_token
+
+
+    def rate(self):
+        # Combined number of requests per second over all tokens
+        with self.lock:
+            return sum([ slot.rate_limiter.rate for slot in self.slots ])
@@ -1,3 +1,11 @@
 from riskmonitor.util.nlputil import NlpUtil
 from riskmonitor.util.geoutil import GeoUtil
-from riskmonitor.util.timeutil import TimeUtil
\ No newline at end of file
+from riskmonitor.util.timeutil import TimeUtil
+
+
+def warmup():
+    # Models, corpora and the JVM are loaded on first use; call this to load them all up front instead
+    # (e.g., before starting worker threads or handling the first request)
+    NlpUtil.warmup()
+    GeoUtil.warmup()
+    TimeUtil.warmup()
@@ -0,0 +1,93 @@
+'''
+DocStore
+
+Local SQLite store of serialized spaCy documents (Doc.to_bytes()), keyed by a hash of the
+text, so that the same version of a text only needs to be parsed once no matter how many
+scripts or analyses use it. Once the total size of all stored documents exceeds max_size
+bytes, the least recently used documents are evicted.
+
+'''
+
+
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+class DocStore:
+
+    MAX_SIZE = 1024 * 1024 * 1024      # 1 GB
+    # Evict down to this fraction of max_size, so that not every put() triggers an eviction
+    EVICTION_TARGET = 0.9
+    # Access times are buffered and written in one transaction every ACCESS_FLUSH_INTERVAL seconds (and before
+    # evicting), so that lookups neither commit every time nor keep a write transaction open
+    ACCESS_FLUSH_INTERVAL = 60
+
+    def __init__(self, path, max_size=None):
+        self.max_size = max_size if max_size is not None else DocStore.MAX_SIZE
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS docs (content_hash TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS docs_last_used ON docs (last_used)")
+        self.db.commit()
+        self.total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM docs").fetchone()[0]
+        self.access_times = {}      # content hash => time of last access, not written yet
+        self.access_flushed_at = time.time()
+
+
+    @staticmethod
+    def content_hash(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+    def get(self, text):
+        # Returns the serialized document of the text, or None if it has not been stored (or has been evicted)
+        content_hash = DocStore.content_hash(text)
+        with self.lock:
+            row = self.db.execute("SELECT data FROM docs WHERE content_hash = ?", (content_hash,)).fetchone()
+            if row is None:
+                return None
+            self.access_times[content_hash] = time.time()
+            if time.time() - self.access_flushed_at >= DocStore.ACCESS_FLUSH_INTERVAL:
+                self._flush_access_times()
+                self.db.commit()
+            return bytes(row[0])
+
+
+    def put(self, text, data):
+        content_hash = DocStore.content_hash(text)
+        with self.lock:
+            row = self.db.execute("SELECT size FROM docs WHERE content_hash = ?", (content_hash,)).fetchone()
+            if row is not None:
+                self.total_size -= row[0]
+            self.db.execute("INSERT OR REPLACE INTO docs (content_hash, data, size, last_used) VALUES (?, ?, ?, ?)", (content_hash, sqlite3.Binary(data), len(data), time.time()))
+            self.total_size += len(data)
+            if self.total_size > self.max_size:
+                self._flush_access_times()
+                self._evict()
+            self.db.commit()
+
+
+    def _flush_access_times(self):
+        self.db.executemany("UPDATE docs SET last_used = ? WHERE content_hash = ?", [ (last_used, content_hash) for content_hash, last_used in self.access_times.items() ])
+        self.access_times = {}
+        self.access_flushed_at = time.time()
+
+
+    def _evict(self):
+        target_size = self.max_size * DocStore.EVICTION_TARGET
+        evicted = []
+        for content_hash, size in self.db.execute("SELECT content_hash, size FROM docs ORDER BY last_used"):
+            if self.total_size <= target_size:
+                break
+            evicted.append((content_hash,))
+            self.total_size -= size
+        self.db.executemany("DELETE FROM docs WHERE content_hash = ?", evicted)
+
+
+    def close(self):
+        with self.lock:
+            self._flush_access_times()
+            self.db.commit()
+            self.db.close()
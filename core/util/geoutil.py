@@ -1,14 +1,25 @@
-from geopy.geocoders import Nominatim
 from geopy.distance import vincenty
+from riskmonitor.util.lazyresource import LazyResource
 
-geolocator = Nominatim()
+
+def _load_geolocator():
+    from geopy.geocoders import Nominatim
+    return Nominatim()
+
+
+geolocator = LazyResource(_load_geolocator)
 
 
 class GeoUtil:
 
+    @staticmethod
+    def warmup():
+        geolocator.get()
+
+
     @staticmethod
     def geocode_location(s):
-        loc = geolocator.geocode(s)
+        loc = geolocator.get().geocode(s)
         if loc is None:
             return None
         return { 'display_name': loc.raw['display_name'], 'type': loc.raw['type'], 'class': loc.raw['class'], 'lat': loc.raw['lat'], 'lng': loc.raw['lon'], 'bounding_box': loc.raw['boundingbox'] }
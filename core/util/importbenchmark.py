@@ -0,0 +1,49 @@
+'''
+Import-time benchmark for riskmonitor.util
+
+Measures (each in a fresh interpreter) how long importing the package takes, now that
+all models and corpora are loaded lazily, and how long warmup() takes to load them. The
+sum of both is roughly what every script paid on import before.
+
+Usage: python importbenchmark.py [<num-runs>]
+
+'''
+
+
+import sys
+import subprocess
+
+
+NUM_RUNS = 3
+
+BENCHMARK_CODE = """
+import time
+start_time = time.time()
+import riskmonitor.util
+import_time = time.time() - start_time
+start_time = time.time()
+riskmonitor.util.warmup()
+print('{} {}'.format(import_time, time.time() - start_time))
+"""
+
+
+def run_benchmark(num_runs):
+    import_times, warmup_times = [], []
+    for _ in range(num_runs):
+        output = subprocess.check_output([sys.executable, '-c', BENCHMARK_CODE]).decode('utf-8').strip().split('\n')[-1]
+        import_time, warmup_time = [ float(value) for value in output.split() ]
+        import_times.append(import_time)
+        warmup_times.append(warmup_time)
+    return min(import_times), min(warmup_times)
+
+
+
+
+if __name__ == '__main__':
+
+    num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_RUNS
+
+    import_time, warmup_time = run_benchmark(num_runs)
+    print("import riskmonitor.util: {:.3f}s".format(import_time))
+    print("warmup():                {:.3f}s".format(warmup_time))
+    print("import + warmup (eager): {:.3f}s".format(import_time + warmup_time))
@@ -0,0 +1,31 @@
+'''
+LazyResource
+
+Holder for an expensive resource (a spaCy model, a corpus, a geocoder, ...) that is only
+created by its factory on the first call of get(), so that importing a module does not
+pay for resources the importing script never uses. Creation is guarded by a lock, so
+that concurrent threads never create the same resource twice.
+
+'''
+
+
+import threading
+
+
+class LazyResource:
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.resource = None
+        self.loaded = False
+
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                # Another thread might have created the resource while this one was waiting for the lock
+                if not self.loaded:
+                    self.resource = self.factory()
+                    self.loaded = True
+        return self.resource
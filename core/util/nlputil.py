@@ -1,47 +1,129 @@
 import string
 
-from spacy.en import English
-from sklearn.feature_extraction.stop_words import ENGLISH_STOP_WORDS
-from nltk.corpus import stopwords
-from nltk.corpus import wordnet as wn
+from collections import Counter
+from riskmonitor.util.docstore import DocStore
+from riskmonitor.util.stoplist import StopList
+from riskmonitor.util.lazyresource import LazyResource
+from riskmonitor.util.wordnetclosure import WordNetClosure
 
 
-nlp = English()
+# spaCy, NLTK and sklearn are only imported and loaded on first use (or by NlpUtil.warmup())
+def _load_nlp():
+    # spaCy >= 2.2.2, like the cron scripts (see TermCountGenerator); spacy.en only exists in spaCy 1.x
+    import spacy
+    return spacy.load('en')
 
 
-class NlpUtil:
+def _load_stop_word_set():
     # A custom stoplist
-    STOP_WORD_SET = set(stopwords.words('english') + ["n't", "'s", "'m", "ca"] + list(ENGLISH_STOP_WORDS))
+    from sklearn.feature_extraction.stop_words import ENGLISH_STOP_WORDS
+    from nltk.corpus import stopwords
+    return set(stopwords.words('english') + ["n't", "'s", "'m", "ca"] + list(ENGLISH_STOP_WORDS))
+
+
+def _load_wordnet():
+    from nltk.corpus import wordnet
+    wordnet.ensure_loaded()
+    return wordnet
+
+
+nlp = LazyResource(_load_nlp)
+stop_word_set = LazyResource(_load_stop_word_set)
+wordnet = LazyResource(_load_wordnet)
+wordnet_closure = WordNetClosure(wordnet)
+stop_list = LazyResource(lambda: StopList(stop_word_set.get(), NlpUtil.SYMBOLS))
+
+
+class NlpUtil:
     # List of symbols we don't care about
     SYMBOLS = " ".join(string.punctuation).split(" ") + ["-----", "---", "...", "“", "”", "'ve"]
+    # Number of texts spaCy processes at once in get_named_entities_many()
+    PIPE_BATCH_SIZE = 64
+    # Store of already parsed documents checked by generate_doc() (see configure_doc_store())
+    DOC_STORE = None
+
+    @staticmethod
+    def warmup():
+        # Load all resources right away instead of on first use
+        nlp.get()
+        stop_word_set.get()
+        wordnet.get()
+
+
+    @staticmethod
+    def get_stop_word_set():
+        return stop_word_set.get()
+
+
+    @staticmethod
+    def get_stop_list():
+        # Precompiled stoplist of the custom stop words and symbols (see StopList)
+        return stop_list.get()
+
+
+    @staticmethod
+    def compile_stop_list(stop_set_list):
+        # Build the stoplist once and pass it instead of stop_set_list to avoid rebuilding it on every call
+        if isinstance(stop_set_list, StopList):
+            return stop_set_list
+        return StopList(*stop_set_list)
+
 
     @staticmethod
     def generate_doc(text):
-        doc = nlp(text)
-        return nlp(text)
+        if NlpUtil.DOC_STORE is None:
+            return nlp.get()(text)
+        data = NlpUtil.DOC_STORE.get(text)
+        if data is not None:
+            from spacy.tokens import Doc
+            return Doc(nlp.get().vocab).from_bytes(data)
+        doc = nlp.get()(text)
+        NlpUtil.DOC_STORE.put(text, doc.to_bytes())
+        return doc
+
+
+    @staticmethod
+    def configure_doc_store(path, max_size=None):
+        # Parsed documents are kept in a local file, so that each text is only parsed once across all scripts
+        if NlpUtil.DOC_STORE is not None:
+            NlpUtil.DOC_STORE.close()
+        NlpUtil.DOC_STORE = DocStore(path, max_size=max_size)
 
 
     @staticmethod
     def get_named_entities(doc, distinct=True, ignore_case=True):
-        seen = set()
+        index = {}      # entity text => item in named_entities (for distinct=True)
         named_entities = []
         for ent in doc.ents:
             if ignore_case:
                 ent_text = ent.text.lower()
             else:
                 ent_text = ent.text
-            if not distinct:
-                named_entities.append({'text': ent_text, 'label': ent.label_, 'start_char': ent.start_char, 'end_char': ent.end_char, 'cnt': 1})
-            else:
-                if ent_text not in seen:
-                    named_entities.append({'text': ent_text, 'label': ent.label_, 'start_char': ent.start_char, 'end_char': ent.end_char, 'cnt': 1})
-                    seen.add(ent_text)
-                else:
-                    item = next(item for item in named_entities if item["text"] == ent_text)
-                    item['cnt'] += 1
+            if distinct and ent_text in index:
+                index[ent_text]['cnt'] += 1
+                continue
+            item = {'text': ent_text, 'label': ent.label_, 'start_char': ent.start_char, 'end_char': ent.end_char, 'cnt': 1}
+            named_entities.append(item)
+            index[ent_text] = item
 
         return named_entities
 
+
+    @staticmethod
+    def get_named_entities_many(texts, distinct=True, ignore_case=True, batch_size=None):
+        # Streams all texts through the spaCy pipeline; returns the list of named entities for each text
+        # (see get_named_entities()) and the number of occurrences of each entity text over all texts
+        if batch_size is None:
+            batch_size = NlpUtil.PIPE_BATCH_SIZE
+        named_entities_list = []
+        corpus_counts = Counter()
+        for doc in nlp.get().pipe(texts, batch_size=batch_size):
+            named_entities = NlpUtil.get_named_entities(doc, distinct=distinct, ignore_case=ignore_case)
+            for item in named_entities:
+                corpus_counts[item['text']] += item['cnt']
+            named_entities_list.append(named_entities)
+        return named_entities_list, corpus_counts
+
     @staticmethod
     def get_noun_chunks(doc):
         noun_chunks = []
@@ -52,50 +134,61 @@ class NlpUtil:
 
     @staticmethod
     def get_hyponyms(word):
-        synsets = wn.synsets(word)
-        print(synsets)
-        for synset in synsets:
-            print("----------------------------")
-            NlpUtil._get_hyponyms(synset)
+        # All (direct and indirect) hyponyms of all synsets of word
+        return wordnet_closure.word_closure(word, 'hyponyms')
 
     @staticmethod
     def _get_hyponyms(synset):
-        hyponyms = set()
-        for hyponym in synset.hyponyms():
-            print(hyponym)
-            hyponyms |= set(NlpUtil._get_hyponyms(hyponym))
-        return hyponyms | set(synset.hyponyms())
+        return set(wordnet_closure.closure(synset, 'hyponyms'))
 
 
     @staticmethod
     def get_hypernyms(word):
-        synsets = wn.synsets(word)
-        print(synsets)
-        for synset in synsets:
-            print("----------------------------")
-            print(NlpUtil._get_hypernyms(synset))
+        # All (direct and indirect) hypernyms of all synsets of word
+        return wordnet_closure.word_closure(word, 'hypernyms')
 
     @staticmethod
     def _get_hypernyms(synset):
-        hypernyms = set()
-        for hypernym in synset.hypernyms():
-            print(hypernym)
-            hypernyms |= set(NlpUtil._get_hypernyms(hypernym))
-        return hypernyms | set(synset.hypernyms())
+        return set(wordnet_closure.closure(synset, 'hypernyms'))
+
+
+    @staticmethod
+    def expand_term(word, relation='hyponyms'):
+        # Names of all synsets related to word (see build_wordnet_index())
+        return wordnet_closure.expand(word, relation)
+
+
+    @staticmethod
+    def build_wordnet_index(words, path=None):
+        # Precompute the hypernym and hyponym closures of a vocabulary (e.g., all risk keywords), optionally saving them to a file
+        wordnet_closure.build_index(words)
+        if path is not None:
+            wordnet_closure.save(path)
+
+
+    @staticmethod
+    def load_wordnet_index(path):
+        wordnet_closure.load(path)
 
     @staticmethod
     def remove_stop_tokens(doc, stop_set_list):
-        s = set()
-        for stop_set in stop_set_list:
-            s = s.union(set(stop_set))
-        return [t for t in doc if t.text.lower() not in s]
+        # stop_set_list: list of stop sets or a StopList (see compile_stop_list())
+        return NlpUtil.compile_stop_list(stop_set_list).filter_tokens(doc)
 
     @staticmethod
     def remove_stop_words(word_list, stop_set_list):
-        s = set()
-        for stop_set in stop_set_list:
-            s = s.union(set(stop_set))
-        return [t for t in word_list if t.text.lower() not in s]
+        # word_list: list of tokens, not necessarily from the same doc; compared by the IDs of their lowercase forms
+        if len(word_list) == 0:
+            return []
+        stop_ids, _ = NlpUtil.compile_stop_list(stop_set_list).get_ids(word_list[0].vocab)
+        return [t for t in word_list if t.lower not in stop_ids]
+
+    @staticmethod
+    def count_terms(doc, stop_set_list=None, pos_tags=None, use_is_stop=False):
+        # Number of occurrences of each lowercase term in doc that is not a stop word (by default, the custom stoplist)
+        # and, if given, whose part-of-speech tag (e.g., 'NOUN') is one of pos_tags
+        compiled_stop_list = NlpUtil.get_stop_list() if stop_set_list is None else NlpUtil.compile_stop_list(stop_set_list)
+        return compiled_stop_list.count_terms(doc, pos_tags=pos_tags, use_is_stop=use_is_stop)
 
 
 
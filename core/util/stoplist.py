@@ -0,0 +1,79 @@
+'''
+StopList
+
+Union of one or more stop sets, built once and converted to the IDs spaCy uses for the
+lowercase forms of words, so that tokens can be filtered and counted on the LOWER, POS
+and IS_STOP columns of doc.to_array() with NumPy, without creating a Python string for
+every token. Only the distinct terms that are left in the end are converted to strings.
+NumPy and spaCy are only imported when a StopList is first applied to a document.
+
+'''
+
+
+class StopList:
+
+    def __init__(self, *stop_sets):
+        words = set()
+        for stop_set in stop_sets:
+            words |= set([ word.lower() for word in stop_set ])
+        self.words = frozenset(words)
+        self.vocab = None
+        self.id_set = None
+        self.id_array = None
+
+
+    def __contains__(self, word):
+        return word.lower() in self.words
+
+
+    def get_ids(self, vocab):
+        # Returns the set and the (sorted) array of the string IDs of all words for the vocabulary; computed once
+        if self.vocab is not vocab:
+            import numpy as np
+            ids = [ vocab.strings[word] for word in self.words ]
+            self.id_set = frozenset(ids)
+            self.id_array = np.array(sorted(ids), dtype=np.uint64)
+            self.vocab = vocab
+        return self.id_set, self.id_array
+
+
+    def keep_mask(self, doc, pos_tags=None, use_is_stop=False):
+        # Boolean array with one entry per token of doc: True for tokens that are not in the stoplist (and, if
+        # given, whose part-of-speech tag is one of pos_tags); returns the mask and the LOWER column
+        import numpy as np
+        from spacy.attrs import LOWER, POS, IS_STOP
+        pos_ids = StopList.get_pos_ids(pos_tags) if pos_tags is not None else None
+        _, id_array = self.get_ids(doc.vocab)
+        array = doc.to_array([LOWER, POS, IS_STOP])
+        lower = array[:, 0].astype(np.uint64)
+        mask = ~np.in1d(lower, id_array, assume_unique=False)
+        if pos_ids is not None:
+            mask &= np.in1d(array[:, 1], pos_ids)
+        if use_is_stop:
+            mask &= array[:, 2] == 0
+        return mask, lower
+
+
+    @staticmethod
+    def get_pos_ids(pos_tags):
+        # IDs of universal part-of-speech tags such as 'NOUN' or 'PROPN'
+        from spacy.parts_of_speech import IDS
+        unknown_tags = [ tag for tag in pos_tags if tag not in IDS ]
+        if len(unknown_tags) > 0:
+            raise ValueError("Unknown part-of-speech tag(s): {}".format(', '.join(map(repr, unknown_tags))))
+        return [ IDS[tag] for tag in pos_tags ]
+
+
+    def filter_tokens(self, doc, pos_tags=None, use_is_stop=False):
+        import numpy as np
+        mask, _ = self.keep_mask(doc, pos_tags=pos_tags, use_is_stop=use_is_stop)
+        return [ doc[i] for i in np.flatnonzero(mask) ]
+
+
+    def count_terms(self, doc, pos_tags=None, use_is_stop=False):
+        # Returns a dictionary lowercase term => number of occurrences for all tokens that are kept
+        import numpy as np
+        mask, lower = self.keep_mask(doc, pos_tags=pos_tags, use_is_stop=use_is_stop)
+        ids, counts = np.unique(lower[mask], return_counts=True)
+        strings = doc.vocab.strings
+        return { strings[int(term_id)]: int(count) for term_id, count in zip(ids, counts) }
@@ -0,0 +1,82 @@
+'''
+TimeResultCache
+
+Bounded cache (least-recently-used eviction) for the datetimes Natty returns for a
+normalized time expression relative to a reference date, each together with a flag
+whether its time of day was implied (i.e., is the time of parsing) rather than given, e.g.:
+
+  ('2 days ago', '2018-05-14') => [(datetime(2018, 5, 12, 9, 41), True)]
+
+Time expressions in news text repeat a lot, so most lookups never reach the JVM. If a
+path is given, all results are also written to a SQLite file and reloaded on a miss,
+so that the cache survives restarts.
+
+'''
+
+
+import json
+import sqlite3
+import threading
+
+from datetime import datetime
+from collections import OrderedDict
+
+
+class TimeResultCache:
+
+    MAX_SIZE = 100000
+
+    def __init__(self, max_size=None, path=None):
+        self.max_size = max_size if max_size is not None else TimeResultCache.MAX_SIZE
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS time_results (expression TEXT NOT NULL, reference_date TEXT NOT NULL, results TEXT NOT NULL, PRIMARY KEY (expression, reference_date))")
+            self.db.commit()
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def get(self, s, reference_date):
+        # Returns the cached list of (datetime, implicit time) tuples, or None if the expression has not been resolved yet
+        key = (s, reference_date.isoformat())
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT results FROM time_results WHERE expression = ? AND reference_date = ?", key).fetchone()
+            if row is None:
+                return None
+            results = [ (datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f'), implicit_time) for value, implicit_time in json.loads(row[0]) ]
+            self._set(key, results)
+            return results
+
+
+    def set_many(self, entries, reference_date):
+        # entries: dictionary expression => list of (datetime, implicit time) tuples
+        reference_date = reference_date.isoformat()
+        with self.lock:
+            for s, results in entries.items():
+                self._set((s, reference_date), results)
+            if self.db is not None and len(entries) > 0:
+                with self.db:
+                    self.db.executemany("INSERT OR REPLACE INTO time_results (expression, reference_date, results) VALUES (?, ?, ?)",
+                                        [ (s, reference_date, json.dumps([ (result.strftime('%Y-%m-%dT%H:%M:%S.%f'), implicit_time) for result, implicit_time in results ])) for s, results in entries.items() ])
+
+
+    def _set(self, key, results):
+        self.items[key] = results
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
@@ -1,6 +1,19 @@
 import re
+import sys
+import time
 
-from natty import DateParser
+from datetime import datetime, timedelta
+from riskmonitor.util.timecache import TimeResultCache
+from riskmonitor.util.lazyresource import LazyResource
+
+
+def _load_date_parser():
+    # Natty runs in a JVM, which is only started on first use (or by TimeUtil.warmup())
+    from natty import DateParser
+    return DateParser
+
+
+date_parser = LazyResource(_load_date_parser)
 
 
 class TimeUtil:
@@ -41,69 +54,279 @@ class TimeUtil:
         'for the time being': 'now'
     }
 
+    # Number suffixes that are removed (ordinals) or expanded (units) by _preprocess_string()
+    ORDINAL_SUFFIXES = {('1', 'st'), ('2', 'nd'), ('3', 'rd')}
+    UNIT_SUFFIXES = {'d': 'days', 'h': 'hours', 'm': 'minutes', 's': 'seconds'}
+
+    # Compiled once at import (see the end of this module)
+    REGEX__NUMBER_SUFFIX = re.compile(r"\b([0-9]+)([a-zA-Z]+)\b")
+    REGEX__WEEKDAY = None
+    REGEX__TIME_PHRASE = None
+
+    # Expressions relative to the current time of day are resolved anew on every call
+    REGEX__VOLATILE = re.compile(r"\b(now|hours?|minutes?|seconds?)\b")
+
+    # Simple expressions that are resolved without Natty (see _process_native()); all times not given by an
+    # expression are set to the current time of day, just like Natty does
+    NATIVE_DAY_OFFSETS = {'now': 0, 'today': 0, 'yesterday': -1, 'tomorrow': 1}
+    NATIVE_UNITS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800}
+    NATIVE_MONTHS = {'jan': 1, 'january': 1, 'feb': 2, 'february': 2, 'mar': 3, 'march': 3, 'apr': 4, 'april': 4, 'may': 5,
+                     'jun': 6, 'june': 6, 'jul': 7, 'july': 7, 'aug': 8, 'august': 8, 'sep': 9, 'sept': 9, 'september': 9,
+                     'oct': 10, 'october': 10, 'nov': 11, 'november': 11, 'dec': 12, 'december': 12}
+
+    REGEX__NATIVE_RELATIVE = re.compile(r"^(?:in )?([0-9]+|an?|one) (second|minute|hour|day|week)s?( ago)?$")
+    REGEX__NATIVE_DAY_MONTH = re.compile(r"^([0-9]{1,2})(?: of)? ([a-z]+)(?:,? ([0-9]{4}))?$")
+    REGEX__NATIVE_MONTH_DAY = re.compile(r"^([a-z]+) ([0-9]{1,2})(?:,? ([0-9]{4}))?$")
+    REGEX__NATIVE_ISO_DATE = re.compile(r"^([0-9]{4})-([0-9]{2})-([0-9]{2})$")
+
+    # Natty results shared by all calls of process_many() (see configure_cache())
+    CACHE = TimeResultCache()
+    # Natty sets times not given by an expression to the current time of day; a result whose time of day is
+    # within this many seconds of the time of parsing is cached as a date only
+    IMPLICIT_TIME_TOLERANCE = 5
 
 
 
+    @staticmethod
+    def warmup():
+        # Start the JVM and let Natty parse a first expression
+        TimeUtil._process_natty('today')
+
+
     @staticmethod
     def process(s, time_format_str=None):
-        s = TimeUtil._preprocess_string(s)
-        s = TimeUtil._handle_day(s)
         # Preprocess string by replacing some "non-standard" words and phrases into "standard" ones
-        # (i.e., words or phrases that Natty handles out of the box)
-        s = TimeUtil._multiple_replace(s)
-        # Evaluate Natty over string
-        time_struct_list = TimeUtil._process_natty(s)
-        if time_struct_list is None:
-            time_struct_list = []
-        # Convert datetime object ot human-readable string if specified
+        # (i.e., words or phrases that Natty handles out of the box) and evaluate it; Natty is only used
+        # for expressions the native resolver cannot handle, and its results are cached (see process_many())
+        return TimeUtil.process_many([s], time_format_str=time_format_str)[0]
+
+
+    @staticmethod
+    def process_many(strings, time_format_str=None):
+        # Resolves a list of strings like process(); every distinct normalized string is resolved only once, and
+        # results are cached for the current day (except for expressions like "2 hours ago" or "now"). Cached
+        # results without an explicit time get the current time of day, just like a new call of Natty would.
+        now = datetime.now()
+        reference_date = now.date()
+        normalized_strings = [ TimeUtil.normalize(s) for s in strings ]
+
+        results, unresolved = {}, set()
+        for s in set(normalized_strings):
+            native = TimeUtil._process_native(s, now=now)
+            if native is not None:
+                results[s] = native
+                continue
+            cached = None if TimeUtil.REGEX__VOLATILE.search(s) else TimeUtil.CACHE.get(s, reference_date)
+            if cached is None:
+                unresolved.add(s)
+            else:
+                results[s] = [ datetime.combine(time_struct.date(), now.time()) if implicit_time else time_struct for time_struct, implicit_time in cached ]
+
+        resolved, cache_entries = {}, {}
+        for s in unresolved:
+            parsed_at = datetime.now()
+            resolved[s] = TimeUtil._process_natty(s) or []
+            if not TimeUtil.REGEX__VOLATILE.search(s):
+                cache_entries[s] = [ (time_struct, TimeUtil._has_implicit_time(time_struct, parsed_at)) for time_struct in resolved[s] ]
+        TimeUtil.CACHE.set_many(cache_entries, reference_date)
+        results.update(resolved)
+
         if time_format_str is not None:
-            time_struct_list = [ time_struct.strftime(time_format_str) for time_struct in time_struct_list]
-        return time_struct_list
+            results = { s: [ time_struct.strftime(time_format_str) for time_struct in time_struct_list ] for s, time_struct_list in results.items() }
+        return [ list(results[s]) for s in normalized_strings ]
+
+
+    @staticmethod
+    def _has_implicit_time(time_struct, parsed_at):
+        implied = datetime.combine(time_struct.date(), parsed_at.time())
+        return abs((time_struct.replace(tzinfo=None) - implied).total_seconds()) <= TimeUtil.IMPLICIT_TIME_TOLERANCE
+
+
+    @staticmethod
+    def configure_cache(max_size=None, path=None):
+        # Replace the default in-memory cache, e.g., by one that is also persisted to a SQLite file
+        TimeUtil.CACHE.close()
+        TimeUtil.CACHE = TimeResultCache(max_size=max_size, path=path)
 
 
     @staticmethod
     def _process_natty(s):
-        dp = DateParser(s)
+        dp = date_parser.get()(s)
         return dp.result()
 
 
+    @staticmethod
+    def _process_native(s, now=None):
+        # Returns the list of datetimes for a normalized string, or None if the string is not a simple expression
+        if now is None:
+            now = datetime.now()
+        s = s.strip()
+
+        if s in TimeUtil.NATIVE_DAY_OFFSETS:
+            return [ now + timedelta(days=TimeUtil.NATIVE_DAY_OFFSETS[s]) ]
+
+        m = TimeUtil.REGEX__NATIVE_RELATIVE.match(s)
+        if m:
+            is_future, is_past = s.startswith('in '), m.group(3) is not None
+            if is_future == is_past:
+                return None
+            count = int(m.group(1)) if m.group(1).isdigit() else 1
+            seconds = count * TimeUtil.NATIVE_UNITS[m.group(2)]
+            return [ now + timedelta(seconds=seconds if is_future else -seconds) ]
+
+        year, month, day = None, None, None
+        m = TimeUtil.REGEX__NATIVE_ISO_DATE.match(s)
+        if m:
+            year, month, day = int(m.group(1)), int(m.group(2)), int(m.group(3))
+        else:
+            for regex, day_group, month_group in [(TimeUtil.REGEX__NATIVE_DAY_MONTH, 1, 2), (TimeUtil.REGEX__NATIVE_MONTH_DAY, 2, 1)]:
+                m = regex.match(s)
+                if m and m.group(month_group) in TimeUtil.NATIVE_MONTHS:
+                    year = int(m.group(3)) if m.group(3) is not None else now.year
+                    month, day = TimeUtil.NATIVE_MONTHS[m.group(month_group)], int(m.group(day_group))
+                    break
+        if month is None:
+            return None
+        try:
+            return [ now.replace(year=year, month=month, day=day) ]
+        except ValueError:
+            # Invalid dates (e.g., "31 february") are left to Natty
+            return None
+
+
+    @staticmethod
+    def normalize(s):
+        # Full string normalization done by process() before the string is handed to Natty
+        return TimeUtil._multiple_replace(TimeUtil._handle_day(TimeUtil._preprocess_string(s)))
+
+
     @staticmethod
     def _handle_day(s):
-        weekdays_str = '|'.join(TimeUtil.KEYWORDS_SET__WEEKDAYS.union(TimeUtil.KEYWORDS_SET__WEEKDAYS_SHORT))
-        p, offset = re.compile(r"(^|\b[a-zA-Z]+\b )\b(%s)\b" %weekdays_str), 0
-        for m in p.finditer(s):
-            prec_word = s[m.start(1)+offset : m.end(1)+offset].strip()
-            print(prec_word)
-            if prec_word not in ['past', 'coming', 'next'] or prec_word in ['last', 'previous']:
-                s = ' '.join(s[:m.end(1)+offset].split() + ['past'] + s[m.start(2)+offset:m.end(2)+offset].split() + s[m.end(2)+offset:].split())
-                offset += len('past')+1 # +1 because of additional whitespace
-        return s
+        # "monday" => "past monday", unless the weekday already comes with "past", "coming" or "next"
+        return TimeUtil.REGEX__WEEKDAY.sub(TimeUtil._replace_weekday, s)
+
+
+    @staticmethod
+    def _replace_weekday(m):
+        if m.group(1).strip() in ['past', 'coming', 'next']:
+            return m.group(0)
+        return '{}past {}'.format(m.group(1), m.group(2))
 
 
     @staticmethod
     def _preprocess_string(s):
-        s = s.lower()
-        s = re.sub(r"(\b[0-9]*1)(st\b)", r"\1", s)
-        s = re.sub(r"(\b[0-9]*2)(nd\b)", r"\1", s)
-        s = re.sub(r"(\b[0-9]*3)(rd\b)", r"\1", s)
-        s = re.sub(r"(\b[0-9]*[0-9])(th\b)", r"\1", s)
-        s = re.sub(r"(\b[0-9]+)(d\b)", r"\1 days", s)           # "12d" => "12 days"
-        s = re.sub(r"(\b[0-9]+)(h\b)", r"\1 hours", s)          # "12h" => "12 hours"
-        s = re.sub(r"(\b[0-9]+)(m\b)", r"\1 minutes", s)        # "12m" => "12 minutes"
-        s = re.sub(r"(\b[0-9]+)(s\b)", r"\1 seconds", s)        # "12s" => "12 seconds"
-        s = re.sub(r"(\b[0-9]+)([a-zA-Z]+\b)", r"\1 \2", s)     # "12xxx" => "12 xxx"
-        return s
+        # Single pass over all numbers with a letter suffix:
+        # "21st" => "21", "12d" => "12 days", "12h" => "12 hours", "12m" => "12 minutes", "12s" => "12 seconds", "12xxx" => "12 xxx"
+        return TimeUtil.REGEX__NUMBER_SUFFIX.sub(TimeUtil._replace_number_suffix, s.lower())
+
+
+    @staticmethod
+    def _replace_number_suffix(m):
+        number, suffix = m.group(1), m.group(2)
+        if suffix == 'th' or (number[-1], suffix) in TimeUtil.ORDINAL_SUFFIXES:
+            return number
+        return '{} {}'.format(number, TimeUtil.UNIT_SUFFIXES.get(suffix, suffix))
 
 
     @staticmethod
     def _multiple_replace(s):
-        # Create a regular expression  from the dictionary keys
-        regex = re.compile("(\b%s\b)" % "|".join(map(re.escape, TimeUtil.TIME_PHRASE_MAPPING.keys())), re.IGNORECASE)
-        # For each match, look-up corresponding value in dictionary
-        return regex.sub(lambda mo: TimeUtil.TIME_PHRASE_MAPPING[mo.string[mo.start():mo.end()].lower()], s)
+        # For each match of the (trie-shaped) phrase regex, look-up corresponding value in dictionary
+        return TimeUtil.REGEX__TIME_PHRASE.sub(lambda mo: TimeUtil.TIME_PHRASE_MAPPING[mo.group(0).lower()], s)
+
+
+    @staticmethod
+    def _build_trie_regex(phrases):
+        # Alternation of all phrases with shared prefixes factored out ("late|later" => "late(?:r)?"), so that the
+        # regex engine never tries more than one branch per character instead of scanning every phrase in turn
+        trie = {}
+        for phrase in phrases:
+            node = trie
+            for c in phrase:
+                node = node.setdefault(c, {})
+            node[''] = True
+        return re.compile(r"\b{}\b".format(TimeUtil._trie_to_pattern(trie)), re.IGNORECASE)
+
+
+    @staticmethod
+    def _trie_to_pattern(node):
+        branches = [ re.escape(c) + TimeUtil._trie_to_pattern(child) for c, child in sorted(node.items()) if c != '' ]
+        if len(branches) == 0:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:{})'.format('|'.join(branches))
+        # Longer phrases are tried first, the phrase ending here is the fallback
+        if '' in node:
+            pattern = '(?:{})?'.format(pattern)
+        return pattern
+
+
+
+
+TimeUtil.REGEX__WEEKDAY = re.compile(r"(^|\b[a-zA-Z]+\b )\b(%s)\b" % '|'.join(sorted(TimeUtil.KEYWORDS_SET__WEEKDAYS.union(TimeUtil.KEYWORDS_SET__WEEKDAYS_SHORT), key=len, reverse=True)))
+TimeUtil.REGEX__TIME_PHRASE = TimeUtil._build_trie_regex(TimeUtil.TIME_PHRASE_MAPPING.keys())
+
+
+def benchmark_normalization(num_strings=100000):
+    # Throughput of TimeUtil.normalize() compared to the former implementation that recompiled its regexes on
+    # every call and ran one re.sub pass per number suffix
+    def normalize_uncompiled(s):
+        s = s.lower()
+        for pattern, replacement in [(r"(\b[0-9]*1)(st\b)", r"\1"), (r"(\b[0-9]*2)(nd\b)", r"\1"), (r"(\b[0-9]*3)(rd\b)", r"\1"),
+                                     (r"(\b[0-9]*[0-9])(th\b)", r"\1"), (r"(\b[0-9]+)(d\b)", r"\1 days"), (r"(\b[0-9]+)(h\b)", r"\1 hours"),
+                                     (r"(\b[0-9]+)(m\b)", r"\1 minutes"), (r"(\b[0-9]+)(s\b)", r"\1 seconds"), (r"(\b[0-9]+)([a-zA-Z]+\b)", r"\1 \2")]:
+            s = re.sub(pattern, replacement, s)
+        weekdays_str = '|'.join(TimeUtil.KEYWORDS_SET__WEEKDAYS.union(TimeUtil.KEYWORDS_SET__WEEKDAYS_SHORT))
+        s = re.compile(r"(^|\b[a-zA-Z]+\b )\b(%s)\b" % weekdays_str).sub(TimeUtil._replace_weekday, s)
+        regex = re.compile(r"\b(%s)\b" % "|".join(map(re.escape, TimeUtil.TIME_PHRASE_MAPPING.keys())), re.IGNORECASE)
+        return regex.sub(lambda mo: TimeUtil.TIME_PHRASE_MAPPING[mo.group(0).lower()], s)
+
+    templates = ["{}d ago", "the {}th of may", "{}h and {}m ago", "last monday late evening", "day before yesterday at {}pm",
+                 "in {} weeks", "next friday early morning", "{}1st march at sunset", "for the time being", "{}s ago"]
+    corpus = [ templates[i % len(templates)].format(i % 31, i % 60) for i in range(num_strings) ]
+
+    for name, normalize in [('uncompiled', normalize_uncompiled), ('compiled', TimeUtil.normalize)]:
+        start_time = time.time()
+        for s in corpus:
+            normalize(s)
+        elapsed = time.time() - start_time
+        print("{:>10}: {} strings in {:.2f}s ({:.0f} strings/s)".format(name, num_strings, elapsed, num_strings / elapsed))
+
+
+
+
+# Expressions covered by the native resolver (see TimeUtil._process_native()) for which both paths must agree
+NATIVE_AGREEMENT_EXPRESSIONS = ["now", "today", "yesterday", "tomorrow", "day before yesterday", "overmorrow", "2 days ago", "3d ago",
+                                "in 2 days", "a week ago", "in 1 week", "fortnight ago", "12h ago", "30m ago", "in 10 minutes",
+                                "26 december", "boxing day", "may 3rd", "december 26, 2017", "1st of march 2018", "2018-05-14"]
+
+
+def check_native_agreement(strings=None, tolerance=60):
+    # Compare the native resolver with Natty for all strings the native resolver handles; results may differ by
+    # a few seconds since both use the current time. Returns the list of disagreeing (string, native, natty) tuples
+    if strings is None:
+        strings = NATIVE_AGREEMENT_EXPRESSIONS
+    disagreements = []
+    for s in strings:
+        normalized = TimeUtil.normalize(s)
+        native = TimeUtil._process_native(normalized)
+        if native is None:
+            print("{:>25}: not handled natively".format(s))
+            continue
+        natty = TimeUtil._process_natty(normalized) or []
+        agree = len(native) == len(natty) and all([ abs((a - b).total_seconds()) <= tolerance for a, b in zip(native, natty) ])
+        print("{:>25}: {} {} {}".format(s, 'OK' if agree else 'MISMATCH', native, natty))
+        if not agree:
+            disagreements.append((s, native, natty))
+    return disagreements
+
+
 
 
 if __name__ == '__main__':
 
-    s = "yesterday early hours"
-    print(TimeUtil.process(s))
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark_normalization()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'check':
+        sys.exit(1 if len(check_native_agreement()) > 0 else 0)
+    else:
+        s = "yesterday early hours"
+        print(TimeUtil.process(s))
\ No newline at end of file
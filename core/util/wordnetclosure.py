@@ -0,0 +1,80 @@
+'''
+WordNetClosure
+
+Transitive closures of the hypernym and hyponym relations of WordNet synsets, e.g., all
+(direct and indirect) hyponyms of "explosion.n.01". Every closure is computed only once
+per synset and memoized; the closures of a complete vocabulary (e.g., all risk keywords)
+can be precomputed with build_index() and persisted with save(), so that expanding a term
+is a dictionary lookup instead of a traversal of the WordNet graph.
+
+'''
+
+
+import json
+import threading
+
+
+class WordNetClosure:
+
+    RELATIONS = ['hypernyms', 'hyponyms']
+
+    def __init__(self, wordnet):
+        # wordnet: LazyResource of the NLTK WordNet corpus reader
+        self.wordnet = wordnet
+        self.lock = threading.Lock()
+        self.closures = { relation: {} for relation in WordNetClosure.RELATIONS }     # relation => synset name => frozenset of synsets
+        self.index = { relation: {} for relation in WordNetClosure.RELATIONS }        # relation => word => frozenset of synset names
+
+
+    def closure(self, synset, relation):
+        # All synsets reachable from synset via relation ("hypernyms" or "hyponyms")
+        closures = self.closures[relation]
+        if synset.name() in closures:
+            return closures[synset.name()]
+        result = set()
+        for related in getattr(synset, relation)():
+            result.add(related)
+            result |= self.closure(related, relation)
+        result = frozenset(result)
+        with self.lock:
+            closures[synset.name()] = result
+        return result
+
+
+    def word_closure(self, word, relation):
+        # Union of the closures of all synsets of word
+        result = set()
+        for synset in self.wordnet.get().synsets(word):
+            result |= self.closure(synset, relation)
+        return result
+
+
+    def expand(self, word, relation):
+        # Names of all synsets in the closure of word; answered from the index if word has been indexed
+        index = self.index[relation]
+        if word not in index:
+            names = frozenset([ synset.name() for synset in self.word_closure(word, relation) ])
+            with self.lock:
+                index[word] = names
+        return index[word]
+
+
+    def build_index(self, words):
+        for word in words:
+            for relation in WordNetClosure.RELATIONS:
+                self.expand(word, relation)
+
+
+    def save(self, path):
+        with self.lock:
+            index = { relation: { word: sorted(names) for word, names in words.items() } for relation, words in self.index.items() }
+        with open(path, 'w') as f:
+            json.dump(index, f)
+
+
+    def load(self, path):
+        with open(path, 'r') as f:
+            index = json.load(f)
+        with self.lock:
+            for relation in WordNetClosure.RELATIONS:
+                self.index[relation].update({ word: frozenset(names) for word, names in index.get(relation, {}).items() })
@@ -391,6 +391,51 @@ News.prototype =  {
   },
   
   
+  addDailyTopWordsBatch : function(req, res) {
+    let body = req.body;
+    
+    if(!Array.isArray(body)){
+      return res.json(new MissingParametersError());
+    }
+    
+    let valuesString = "";
+
+    for (let i = 0; i < body.length; i++) {
+      let item = body[i];
+      
+      if(!item.hasOwnProperty('published_at') || !item.hasOwnProperty('source') || !item.hasOwnProperty('category') || !item.hasOwnProperty('data')){
+        return res.json(new MissingParametersError());
+      }
+      
+      if (moment(item['published_at'], moment.ISO_8601).isValid() == false) {
+        return res.json(new IncorrectTimestampFormat());
+      }
+      
+      let wordFrequencies = item['data'];
+      
+      for (let word in wordFrequencies) {
+        valuesString += "(TIMESTAMP(" + mysql.connection.escape(item['published_at']) + "), " + mysql.connection.escape(item['source']) + ", " + mysql.connection.escape(item['category']) + ", " + mysql.connection.escape(word) + ", " + mysql.connection.escape(wordFrequencies[word]) + "), ";
+      }
+    }
+    valuesString = valuesString.slice(0, -2); // Remove trailing comma and whitespace
+    
+    if (valuesString != '') {
+      mysql.connection.query(
+        "INSERT IGNORE INTO rpm_news_articles_top_words_daily (published_at, article_source, article_category, word, word_count) VALUES " + valuesString + " ON DUPLICATE KEY UPDATE word_count=VALUES(word_count)",
+        function (error, result, fields) {
+        if (error) { 
+          errorlog.error(error);
+          res.json(new DatabaseError());
+        } else {
+          res.json({"msg": "OK"});
+        }
+      });
+    } else {
+      res.json({"msg": "NOT QUITE OK"});
+    }
+  },
+  
+  
 //   updateCategory : function (req, res) {
 //     let body = req.body;
 //     
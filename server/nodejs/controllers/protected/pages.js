@@ -65,6 +65,54 @@ Pages.prototype =  {
   },
   
   
+  updateSocialSignalsBatch : function (req, res) {
+    let body = req.body;
+
+    if(!Array.isArray(body)){
+      return res.json(new MissingParametersError());
+    }
+    
+    if (body.length == 0) {
+      return res.json({"msg": "success (nothing to do; no signals provided)"});
+    }
+    
+    let values = [];
+    
+    for (let i = 0; i < body.length; i++) {
+      let item = body[i];
+      
+      if(!item.hasOwnProperty('url') && !item.hasOwnProperty('url_id')){
+        return res.json(new MissingParametersError());
+      }
+      
+      if(!item.hasOwnProperty('signal_source') ||  !item.hasOwnProperty('signal_type') || !item.hasOwnProperty('signal_value')){
+        return res.json(new MissingParametersError());
+      }
+      
+      let urlId = -1;
+      if(item.url_id) {
+        urlId = bigInt(item.url_id);
+      } else {
+        urlId = bigInt(farmhash.hash64(item.url));
+      }
+      
+      values.push([ urlId.toString(), item['signal_source'], item['signal_type'], item['signal_value'] ]);
+    }
+    
+    mysql.connection.query(
+      "INSERT INTO rpm_pages_social_signals (url_id, signal_source, signal_type, signal_value) VALUES ? ON DUPLICATE KEY UPDATE signal_value = VALUES(signal_value)",
+      [ values ],
+      function (error, result, fields) {
+      if (error) { 
+        errorlog.error(error);
+        return res.json(new DatabaseError());
+      } else {
+        return res.json({"msg": "success"});
+      }
+    });
+  },
+  
+  
   updateCategories : function (req, res) {
     let body = req.body;
 
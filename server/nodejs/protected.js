@@ -95,10 +95,12 @@ Server.Http.prototype = {
     
     this.app.post('/api/v1/newsarticles/', news.addArticle);
     this.app.post('/api/v1/newsarticles/topwords/daily/', news.addDailyTopWords);
+    this.app.post('/api/v1/newsarticles/topwords/daily/batch/', news.addDailyTopWordsBatch);
     //this.app.post('/api/v1/newsarticles/category/', news.updateCategory);
     
     this.app.post('/api/v1/pages/categories/', pages.updateCategories);
     this.app.post('/api/v1/pages/socialsignals/', pages.updateSocialSignals);
+    this.app.post('/api/v1/pages/socialsignals/batch/', pages.updateSocialSignalsBatch);
 
     this.app.post('/api/v1/content/categories/', content.updateCategories);
     this.app.post('/api/v1/content/socialsignals/', content.updateSocialSignals);
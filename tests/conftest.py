@@ -0,0 +1,17 @@
+import os
+import sys
+import types
+
+
+# The contents of core/ are deployed as the riskmonitor package; map riskmonitor.util onto core/util
+# without running its __init__.py, so that each test only imports the helpers it needs
+CORE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'core')
+
+if 'riskmonitor' not in sys.modules:
+    riskmonitor = types.ModuleType('riskmonitor')
+    riskmonitor.__path__ = [CORE_DIR]
+    util = types.ModuleType('riskmonitor.util')
+    util.__path__ = [os.path.join(CORE_DIR, 'util')]
+    riskmonitor.util = util
+    sys.modules['riskmonitor'] = riskmonitor
+    sys.modules['riskmonitor.util'] = util
@@ -0,0 +1,67 @@
+import pytest
+
+from datetime import datetime, timedelta
+
+from riskmonitor.util import timeutil
+from riskmonitor.util.timeutil import TimeUtil
+from riskmonitor.util.timecache import TimeResultCache
+
+
+NOW = datetime(2018, 5, 16, 23, 59, 30)
+
+
+class FixedDatetime(datetime):
+
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+
+def mock_natty(monkeypatch, results):
+    # Replaces Natty with a lookup in results (normalized string => function of the current time), pins the
+    # current time to NOW and starts with an empty cache; returns the list of strings passed to Natty
+    calls = []
+    results = { TimeUtil.normalize(s): result for s, result in results.items() }
+
+    def process_natty(s):
+        calls.append(s)
+        return [ results[s](NOW) ] if s in results else None
+
+    monkeypatch.setattr(timeutil, 'datetime', FixedDatetime)
+    monkeypatch.setattr(TimeUtil, '_process_natty', staticmethod(process_natty))
+    monkeypatch.setattr(TimeUtil, 'CACHE', TimeResultCache())
+    return calls
+
+
+@pytest.mark.parametrize('s', timeutil.NATIVE_AGREEMENT_EXPRESSIONS)
+def test_native_resolver_handles_expression(s):
+    assert TimeUtil._process_native(TimeUtil.normalize(s)) is not None
+
+
+def test_native_and_natty_agree():
+    # Needs Natty (and a JVM); results of both are relative to the current time and compared with a tolerance
+    pytest.importorskip('natty')
+    assert timeutil.check_native_agreement() == []
+
+
+def test_process_uses_natty_only_as_fallback(monkeypatch):
+    monday = datetime(2018, 5, 14, 9, 30)
+    calls = mock_natty(monkeypatch, { "past monday": lambda now: monday })
+    assert TimeUtil.process("2 days ago", time_format_str='%Y-%m-%d') == ['2018-05-14']
+    assert calls == []
+    assert TimeUtil.process("monday") == [monday]
+    assert calls == ["past monday"]
+
+
+def test_process_caches_natty_results(monkeypatch):
+    monday = datetime(2018, 5, 14, 9, 30)
+    calls = mock_natty(monkeypatch, { "past monday": lambda now: monday })
+    assert TimeUtil.process("monday") == [monday]
+    assert TimeUtil.process("Monday") == [monday]
+    assert calls == ["past monday"]
+
+
+def test_unresolved_expression_is_empty(monkeypatch):
+    calls = mock_natty(monkeypatch, {})
+    assert TimeUtil.process_many(["no time here", "yesterday"]) == [[], [NOW - timedelta(days=1)]]
+    assert calls == ["no time here"]